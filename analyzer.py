@@ -2,18 +2,37 @@
 Module to evaluate pooled outputs against trained patterns
 implements cosine evaluation and euclidian distance evaliation
 """
+import itertools
 import numpy as np
+import cnn
+import filters
+import verdict as vd
+import profiler
 """
 using cosine
 """
+# margin covering the rounding of the similarities computed from quantized samples
+COSINE_MARGIN = 1e-6
+
 class Cosine:
     """
     class implementing cosine similarity evaluation
     between trained data and new input pooled data
     """
-    def __init__(self, training_data, new_data) -> None:
+    def __init__(self, training_data, new_data, trained_norms=None, quantized=None) -> None:
+        """
+        @param training_data: trained samples, (rows, samples) matrix
+        @param new_data: new data obtained via convolution
+        @param trained_norms: norm of each trained row, computed when not provided
+        @param quantized: quantized trained samples, (quantization.QuantizedRows),
+                          the similarities are then computed from the codes
+        """
         self._trained_data = training_data
         self._new_data = new_data
+        if trained_norms is None:
+            trained_norms = np.linalg.norm(training_data, axis=1)
+        self._trained_norms = trained_norms
+        self._quantized = quantized
 
     def __enter__(self) -> 'Cosine':
         return self
@@ -21,47 +40,57 @@ class Cosine:
     def __exit__(self, exc_type, exc_val, exc_tb)-> None:
         del self._trained_data
         del self._new_data
-
-    def cosine_similarity(self, trained_data, new_data):
-        """
-        evaluare cosine similarity new data vs trained data
-        @param: trained data; data already processed
-        @param new_data : new data obtained via convolution
-        """
-        vectA = np.array(new_data)
-        vectB = np.array(trained_data)
-        # Calculate norms
-        norm_A = np.linalg.norm(vectA)
-        norm_B = np.linalg.norm(vectB)
-        # Check if either magnitude is zero or very close to zero
-        if norm_A == 0.0 or norm_B == 0.0:
-            return 0.0
-        return np.dot(vectA, vectB) / (norm_A * norm_B)
-
-    def get_similarity(self, trained_data, new_data):
-        """
-        returns the max similarity for the given input and trained data
-        @param new_data : new data obtained via convolution
-        @param: trained data; data already processed
-        """
-        results = []
-        for trained_row in trained_data:
-            similarity = self.cosine_similarity(trained_row, new_data)
-            results.append((trained_row, similarity))
-        # Sort by similarity in descending order
-        results.sort(key=lambda x: x[1], reverse=True)
-        # results [0][1] is highest similarity among the whole set
-        return results[0][1]
+        del self._trained_norms
+        del self._quantized
 
     def evaluate_cosine(self):
-        results = []
-        t_data = [ t_row[0] for t_row in list(self._trained_data) ]
-        # debug
-        # print("pooled_data=", self._new_data.tolist())
-        # print("trained_data=", t_data)
-        for pool_row in self._new_data.tolist():
-            results.append(self.get_similarity(t_data, pool_row))
-        return results
+        """
+        returns, for each pooled row, the max cosine similarity among
+        all the trained rows; computed as one normalized matrix product,
+        the similarity is 0 when one of the vectors has a zero norm
+        """
+        pooled = np.asarray(self._new_data, dtype=self._trained_data.dtype)
+        pooled_norms = np.linalg.norm(pooled, axis=1)
+        if self._quantized is not None:
+            return self.evaluate_quantized(pooled, pooled_norms)
+        similarity = self.similarity(pooled @ self._trained_data.T, pooled_norms, self._trained_norms)
+        return similarity.max(axis=1).tolist()
+
+    def evaluate_quantized(self, pooled, pooled_norms):
+        """
+        evaluate_cosine from the codes of the unit rows: the similarity of a
+        dequantized unit row is within the quantization error of the exact
+        one, the rows which can still hold the max of a pooled row are
+        re-ranked with their exact samples, (their product may round one ulp
+        away from the one of all the rows); the scale and the pooled norms
+        are applied to the lower bounds, not to the products
+        @param pooled: (pooled rows, samples) matrix
+        @param pooled_norms: norm of each pooled row
+        """
+        products = self._quantized.dot(pooled)
+        bound = self._quantized.error * (1 + COSINE_MARGIN) + COSINE_MARGIN
+        # the exact similarity of the best row of the codes is a lower bound of
+        # the max, a row can only hold the max when its codes are within the bound
+        best = products.argmax(axis=1)
+        norms = pooled_norms * self._trained_norms[best]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lower = np.where(norms == 0.0, 0.0, np.einsum('ij,ij->i', pooled, self._trained_data[best]) / norms)
+        # in code units, the similarities to a zero pooled row are 0
+        lower = np.where(pooled_norms > 0.0, (lower - bound) * pooled_norms / self._quantized.scale, np.inf)
+        candidates = products >= lower[:, None]
+        rows = np.flatnonzero(np.logical_or.reduce(candidates, axis=0))
+        exact = self.similarity(pooled @ self._trained_data[rows].T, pooled_norms, self._trained_norms[rows])
+        maxima = np.where(candidates[:, rows], exact, -np.inf).max(axis=1, initial=-np.inf)
+        return np.where(pooled_norms > 0.0, maxima, 0.0).tolist()
+
+    @staticmethod
+    def similarity(dots, pooled_norms, trained_norms):
+        """
+        returns the cosine similarities from the dot products, (pooled rows, trained rows)
+        """
+        norms = pooled_norms[:, None] * trained_norms[None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(norms == 0.0, 0.0, dots / norms)
 
 def display_cosine_result(output) -> None:
     """
@@ -74,15 +103,38 @@ def display_cosine_result(output) -> None:
             similarity.append(cos)
         print(f"Cosine max similarity '{max(similarity)}' for kernel '{key}'")
 
+# relative margin covering the rounding of the vectorized distances and norms,
+# pairs closer than this to the threshold are checked with the reference formula
+EUCLIDIAN_MARGIN = 1e-9
+# same margin for trained data held in float32, (precision.py)
+EUCLIDIAN_MARGIN_FLOAT32 = 1e-5
+
 class Euclidian:
     """
     class implementing euclidian distance evaluation
     between trained data and new input pooled data
     """
-    def __init__(self, training_data, input_pooled) -> None:
+    def __init__(self, training_data, input_pooled, trained_norms=None, norm_index=None, quantized=None) -> None:
+        """
+        @param training_data: trained samples, (rows, samples) matrix
+        @param input_pooled: new input samples to evaluate
+        @param trained_norms: norm of each trained row, computed when not provided
+        @param norm_index: (row order, sorted norms), computed when not provided
+        @param quantized: quantized trained samples, (quantization.QuantizedRows),
+                          the distances are then computed from the codes
+        """
         self._trained_data = training_data
         self._input_pooled = input_pooled
-        self._euclidean_distance = lambda vec1, vec2: np.linalg.norm(vec1 - vec2)
+        if trained_norms is None:
+            trained_norms = np.linalg.norm(training_data, axis=1)
+        if norm_index is None:
+            order = np.argsort(trained_norms, kind='stable')
+            norm_index = (order, trained_norms[order])
+        self._norm_index = norm_index
+        self._quantized = quantized
+        self._margin = EUCLIDIAN_MARGIN if training_data.dtype == np.float64 else EUCLIDIAN_MARGIN_FLOAT32
+        # the reference formula runs in float64 whatever the precision of the trained data
+        self._euclidean_distance = lambda vec1, vec2: np.linalg.norm(np.asarray(vec1, dtype=np.float64) - vec2)
 
     def __enter__(self) -> 'Euclidian':
         return self
@@ -90,34 +142,140 @@ class Euclidian:
     def __exit__(self, exc_type, exc_val, exc_tb)-> None:
         del self._trained_data
         del self._input_pooled
+        del self._norm_index
+        del self._quantized
+
+    def count_matches(self, pooled_row) -> int:
+        """
+        returns the number of trained rows closer to the pooled row than
+        9% of the pooled row average; by the triangle inequality only the
+        trained rows with | norm(trained) - norm(pooled) | < threshold can
+        match, they are found by a binary search in the sorted norms
+        @param pooled_row: one row of the input pooled map
+        """
+        # same expression as the reference, as a python float so the margins
+        # below are not rounded to the pooled map dtype
+        threshold = float(np.sum(np.array(pooled_row))/len(pooled_row) * 0.09)
+        if not threshold > 0:
+            return 0
+        order, sorted_norms = self._norm_index
+        pooled_norm = np.linalg.norm(np.asarray(pooled_row, dtype=np.float64))
+        band = threshold * (1 + self._margin)
+        low = np.searchsorted(sorted_norms, pooled_norm - band, side='left')
+        high = np.searchsorted(sorted_norms, pooled_norm + band, side='right')
+        if low >= high:
+            return 0
+        if self._quantized is not None:
+            return self.count_quantized_matches(order[low:high], sorted_norms[low:high], pooled_row, threshold)
+        return self.count_exact_matches(order[low:high], pooled_row, threshold)
+
+    def count_exact_matches(self, rows, pooled_row, threshold) -> int:
+        """
+        count_matches of the candidate rows from their exact samples
+        @param rows: index of the candidate trained rows
+        @param pooled_row: one row of the input pooled map
+        @param threshold: distance threshold of the pooled row
+        """
+        candidates = self._trained_data[rows]
+        distances = np.linalg.norm(candidates - pooled_row, axis=1)
+        _matches = int(np.count_nonzero(distances < threshold * (1 - self._margin)))
+        # distances too close to the threshold are computed again like the reference
+        for i in np.flatnonzero(np.abs(distances - threshold) <= threshold * self._margin):
+            _matches += int(self._euclidean_distance(candidates[i], pooled_row) < threshold)
+        return _matches
 
-    def iterate_in_samples(self) -> tuple:
+    def count_quantized_matches(self, rows, norms, pooled_row, threshold) -> int:
         """
-        Generator to iterate through trained samples and input pooled data
+        count_matches of the candidate rows from their codes: the distance to
+        a dequantized row is within error * norm of the exact one, the rows
+        which the error can move across the threshold are counted with their
+        exact samples, so the count is the one of the exact rows
+        @param rows: index of the candidate trained rows
+        @param norms: norm of each candidate row, (from the norm index)
+        @param pooled_row: one row of the input pooled map
+        @param threshold: distance threshold of the pooled row
         """
-        for _pool_row in self._input_pooled:
-            for _train_row in self._trained_data:
-                if _pool_row is not None and _train_row is not None:
-                    yield _pool_row, _train_row
+        dequantized = self._quantized.dequantize(rows, self._trained_data.dtype) * norms[:, None]
+        distances = np.linalg.norm(dequantized - pooled_row, axis=1)
+        # the margin also covers the rounding of the dequantized rows
+        errors = norms * (self._quantized.error + self._margin)
+        _matches = int(np.count_nonzero(distances + errors < threshold * (1 - self._margin)))
+        uncertain = np.flatnonzero(np.abs(distances - threshold) <= threshold * self._margin + errors)
+        if len(uncertain):
+            _matches += self.count_exact_matches(rows[uncertain], pooled_row, threshold)
+        return _matches
 
     def evaluate_euclidian(self) -> tuple:
         """
         Evaluates a single pooled filter result against trained
         patterns using euclidean distance; returns a touple of
         matches and not matches
-        @param trained_filter: list of trained samples for a kernel
-        @param input_pooled: new input samples to evaluate
         """
         _matches = 0
-        _iterations = 0
-        for _pooled_row, _trained_row in self.iterate_in_samples():
-            _iterations += 1
-            _distance = self._euclidean_distance(_trained_row, _pooled_row)
-            _nv_average = np.sum(np.array(_pooled_row))/len(_pooled_row)
-            _matches += int(_distance < _nv_average * 0.09)
-            #TODO, add a fast euclidian match
+        for _pooled_row in self._input_pooled:
+            _matches += self.count_matches(_pooled_row)
+        _iterations = len(self._input_pooled) * len(self._trained_data)
         return _matches, _iterations - _matches
 
+def evaluate_kernel(trained, key, pooled, euclidian=True, cosine=True) -> tuple:
+    """
+    evaluate the pooled map of a kernel against its trained data, chunk by
+    chunk of trained rows; the match counts are summed and the cosine maxima
+    combined, so the results do not depend on the chunking. Returns
+    ((matches, not matches), cosine max similarity per pooled row)
+    @param trained: trained data, (chunks() of trained_store.TrainedDataStore
+                    or storage.StreamingTrainedData)
+    @param key: kernel key
+    @param pooled: pooled map of the kernel
+    @param euclidian: False to only evaluate the cosine, (matches) is then None
+    @param cosine: False to only evaluate the euclidian distances, the cosine maxima are then None
+    """
+    return evaluate_kernel_batch(trained, key, [pooled], euclidian, cosine)[0]
+
+def evaluate_kernel_batch(trained, key, pooled_maps, euclidian=True, cosine=True) -> list:
+    """
+    evaluate_kernel over the pooled maps of several images: the rows of all
+    the maps are stacked, so every chunk of trained rows is read once and
+    evaluated in one matrix product; returns one evaluate_kernel result per map
+    @param trained: trained data, (see evaluate_kernel)
+    @param key: kernel key
+    @param pooled_maps: pooled map of the kernel for each image
+    @param euclidian: False to only evaluate the cosine
+    @param cosine: False to only evaluate the euclidian distances
+    """
+    pooled = pooled_maps[0] if len(pooled_maps) == 1 else np.concatenate(pooled_maps)
+    # first pooled row of each image
+    offsets = list(itertools.accumulate((len(pooled_map) for pooled_map in pooled_maps), initial=0))
+    _matches = np.zeros(len(pooled), dtype=np.int64)
+    _trained_rows = 0
+    _chunks = 0
+    _cosine = None
+    for _trained_filter, _trained_norms, _norm_index, _quantized in trained.chunks(key):
+        if euclidian:
+            with profiler.span("evaluate_euclidian", kernel=key, rows=len(_trained_filter), images=len(pooled_maps)):
+                with Euclidian(_trained_filter, pooled, _trained_norms, _norm_index, _quantized) as eucl:
+                    _matches += [eucl.count_matches(_pooled_row) for _pooled_row in pooled]
+        _trained_rows += len(_trained_filter)
+        _chunks += 1
+        if not cosine:
+            continue
+        with profiler.span("evaluate_cosine", kernel=key, rows=len(_trained_filter), images=len(pooled_maps)):
+            with Cosine(_trained_filter, pooled, _trained_norms, _quantized) as cosine:
+                _similarity = cosine.evaluate_cosine()
+        _cosine = _similarity if _cosine is None else np.maximum(_cosine, _similarity).tolist()
+    if _chunks == 0:
+        raise ValueError(f"no trained data for kernel '{key}'")
+    results = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        _image_cosine = _cosine[start:end] if cosine else None
+        if not euclidian:
+            results.append((None, _image_cosine))
+            continue
+        _image_matches = int(_matches[start:end].sum())
+        _iterations = int(end - start) * _trained_rows
+        results.append(((_image_matches, _iterations - _image_matches), _image_cosine))
+    return results
+
 def evaluate(pooled_maps, shape, db, verbose=False) -> dict:
     """
     Returns a dict containing two maps:
@@ -125,36 +283,57 @@ def evaluate(pooled_maps, shape, db, verbose=False) -> dict:
     a map containing the cosine max similarities per shape
     @param pooled_maps: map of kernel shapes to pooled outputs
     @param shape: a shape dictionary from filters.py
-    @param db: database interface to get trained data
+    @param db: trained data, in memory or streamed, (see evaluate_kernel)
     @param verbose: verbose mode
     """
     _euclidian_result = {}
     _cosine_result = {}
-    for key in pooled_maps:
-        """
-        get the trained pooled maps for each filter
-        """
-        _trained_filter = db.get_trained_data(key)
-        _trained_filter = np.array(_trained_filter)
-        # evaluate euclidian distance and cosine similarity
-        # -------------------------------------------------
-        with Euclidian(_trained_filter, pooled_maps[key]) as eucl:
-            _euclidian_result[key] = eucl.evaluate_euclidian()
+    with profiler.span("evaluate", shape=shape['name']):
+        for key in pooled_maps:
+            # evaluate euclidian distance and cosine similarity
+            # -------------------------------------------------
+            _euclidian_result[key], _cosine_result[key] = evaluate_kernel(db, key, pooled_maps[key])
+    return shape_result(_euclidian_result, _cosine_result, shape, verbose)
 
-        with Cosine(_trained_filter, pooled_maps[key]) as cosine:
-            _cosine_result[key] = cosine.evaluate_cosine()
+def evaluate_batch(pooled_maps, shape, db) -> list:
+    """
+    evaluate over the pooled maps of several images, the kernels are
+    evaluated for all the images at once, (see evaluate_kernel_batch);
+    returns one evaluate result per image
+    @param pooled_maps: map of kernel shapes to pooled outputs, for each image
+    @param shape: a shape dictionary from filters.py
+    @param db: trained data, in memory or streamed, (see evaluate_kernel)
+    """
+    _euclidian_results = [{} for _ in pooled_maps]
+    _cosine_results = [{} for _ in pooled_maps]
+    with profiler.span("evaluate", shape=shape['name'], images=len(pooled_maps)):
+        for key in shape['filters']:
+            kernel_results = evaluate_kernel_batch(db, key, [image_maps[key] for image_maps in pooled_maps])
+            for i, (_euclidian, _cosine) in enumerate(kernel_results):
+                _euclidian_results[i][key] = _euclidian
+                _cosine_results[i][key] = _cosine
+    return [shape_result(_euclidian_result, _cosine_result, shape)
+            for _euclidian_result, _cosine_result in zip(_euclidian_results, _cosine_results)]
 
+def shape_result(euclidian_result, cosine_result, shape, verbose=False) -> dict:
+    """
+    Returns the evaluate result of a shape from the results of its kernels
+    @param euclidian_result: map of kernel key to (matches, not matches)
+    @param cosine_result: map of kernel key to the cosine max similarity per pooled row
+    @param shape: a shape dictionary from filters.py
+    @param verbose: verbose mode
+    """
     if verbose:
         print(f"analyse result for shape '{shape['name']}'")
         print("========================================")
         # display the euclidian evaluation
-        print(_euclidian_result)
+        print(euclidian_result)
         # display the cosine evaluation
-        display_cosine_result(_cosine_result)
+        display_cosine_result(cosine_result)
 
     ## evaluate the cosine results
     _cosine_eval  = 0
-    for key, values in _cosine_result.items():
+    for key, values in cosine_result.items():
         _similarity = []
         for c in values:
             _similarity.append(c)
@@ -163,12 +342,171 @@ def evaluate(pooled_maps, shape, db, verbose=False) -> dict:
         print("total of cosine kernel similarities", _cosine_eval)
 
     ## evaluate the euclidian results
-    _total_matches = sum(1 for m in [ _euclidian_result[key][0] for key in _euclidian_result ] if m > 0)
+    _total_matches = sum(1 for m in [ euclidian_result[key][0] for key in euclidian_result ] if m > 0)
     _result = {}
-    _result['euclidian'] = _total_matches / len(_euclidian_result) if len(_euclidian_result) > 0 else 0
+    _result['euclidian'] = _total_matches / len(euclidian_result) if len(euclidian_result) > 0 else 0
     _result['cosine'] = _cosine_eval
     return _result
 
+def image_name(image) -> str:
+    """
+    returns the name of an image for the profiling
+    @param image: path to the image file, cnn.DecodedImage or a binary file object
+    """
+    if isinstance(image, cnn.DecodedImage):
+        return image.name
+    return image if isinstance(image, str) else "<data>"
+
+def analyse_image(image, db, width, verbose=False) -> dict:
+    """
+    process an image with all the shapes from filters.py and issue the verdict;
+    returns a dict with the euclidian confidence per shape, the cosine
+    evaluation per shape and the verdict
+    @param image: path to the image file, cnn.DecodedImage or a binary file object
+    @param db: trained data, in memory or streamed, (see evaluate_kernel)
+    @param width: image width to resize
+    @param verbose: verbose mode
+    """
+    eucl_result = {}
+    cosine_result = {}
+    with profiler.span("analyse_image", image=image_name(image)):
+        with cnn.ImageProcessor(image, width, False) as img_proc:
+            img_proc.pre_processing()
+            _pooled_maps = img_proc.process_shapes(filters.shapes)
+            for shape in filters.shapes:
+                result = evaluate(_pooled_maps[shape['name']], shape, db, verbose)
+                eucl_result[shape['name']] = result['euclidian']
+                cosine_result[shape['name']] = result['cosine']
+        with profiler.span("verdict"):
+            _verdict = vd.verdict(cosine_result, eucl_result)
+    return {
+        'euclidian': eucl_result,
+        'cosine': cosine_result,
+        'verdict': _verdict
+    }
+
+def analyse_images(images, db, width) -> list:
+    """
+    batched analyse_image over several images, the images of the same size
+    are processed together, (cnn.BatchProcessor), and the kernels evaluated
+    for all the images at once; returns one analyse_image result per image
+    @param images: paths to the image files or cnn.DecodedImage
+    @param db: trained data, in memory or streamed, (see evaluate_kernel)
+    @param width: image width to resize
+    """
+    results = [{'euclidian': {}, 'cosine': {}} for _ in images]
+    with profiler.span("analyse_images", images=len(images)):
+        with cnn.BatchProcessor(images, width) as batch_proc:
+            batch_proc.pre_processing()
+            _pooled_maps = batch_proc.process_shapes(filters.shapes)
+        for shape in filters.shapes:
+            shape_results = evaluate_batch([image_maps[shape['name']] for image_maps in _pooled_maps], shape, db)
+            for result, _shape_result in zip(results, shape_results):
+                result['euclidian'][shape['name']] = _shape_result['euclidian']
+                result['cosine'][shape['name']] = _shape_result['cosine']
+        with profiler.span("verdict", images=len(images)):
+            for result in results:
+                result['verdict'] = vd.verdict(result['cosine'], result['euclidian'])
+    return results
+
+def analyse_image_cascade(image, db, width, verbose=False) -> dict:
+    """
+    same verdict as analyse_image, the cheap signals are computed first:
+    - the kernels of the shapes are pooled and evaluated with cosine one at a
+      time, a shape is dropped as soon as its cosine evaluation can not reach
+      the verdict threshold; when no shape can reach it the verdict is
+      "Unknown pattern" without the remaining kernels nor the euclidian
+      evaluation, (the euclidian results are then empty and the cosine
+      results partial)
+    - the euclidian distances are evaluated one kernel of every shape at a
+      time, a shape stops at its first kernel without match, (below 100 %);
+      when exactly one shape matches with all its kernels it is the verdict,
+      (verdict.check_for_100_shape), without the remaining kernels, (the
+      euclidian results then only hold that shape)
+    - otherwise the remaining kernels are evaluated, the cosine maxima
+      already computed are kept, and the verdict is issued like analyse_image
+    @param image: path to the image file, cnn.DecodedImage or a binary file object
+    @param db: trained data, in memory or streamed, (see evaluate_kernel)
+    @param width: image width to resize
+    @param verbose: verbose mode
+    """
+    with profiler.span("analyse_image", image=image_name(image), cascade=True):
+        with cnn.ImageProcessor(image, width, False) as img_proc:
+            img_proc.pre_processing()
+            kernels = {key: kernel for shape in filters.shapes for key, kernel in shape['filters'].items()}
+            # one batched convolution, the kernels are pooled one at a time
+            img_proc.plan(kernels)
+            _pooled_maps = {}
+
+            def pool(keys):
+                missing = {key: kernels[key] for key in keys if key not in _pooled_maps}
+                if missing:
+                    _pooled_maps.update(img_proc.pooled_maps(missing))
+
+            pending = {shape['name']: list(shape['filters']) for shape in filters.shapes}
+            cosine_sums = {shape['name']: 0.0 for shape in filters.shapes}
+            # cosine max similarity per pooled row, and euclidian (matches, not matches), per evaluated kernel
+            cosine_result = {}
+            eucl_result = {}
+            while True:
+                live = [name for name, keys in pending.items()
+                        if keys and vd.cosine_reachable(cosine_sums[name], len(keys))]
+                if not live:
+                    break
+                # next kernel of every shape still able to pass, in one batch
+                pool(pending[name][0] for name in live)
+                for name in live:
+                    key = pending[name].pop(0)
+                    cosine_result[key] = evaluate_kernel(db, key, _pooled_maps[key], euclidian=False)[1]
+                    cosine_sums[name] += max(cosine_result[key])
+            if max(cosine_sums.values()) < vd.COSINE_THRESHOLD:
+                if verbose:
+                    print(f"cascade: no shape can reach the cosine threshold {vd.COSINE_THRESHOLD}, "
+                          f"{len(_pooled_maps)} of {len(kernels)} kernels evaluated")
+                return {'euclidian': {}, 'cosine': cosine_sums, 'verdict': "Unknown pattern"}
+
+            pending = {shape['name']: list(shape['filters']) for shape in filters.shapes}
+            unmatched = set()
+            while True:
+                live = [name for name, keys in pending.items() if keys and name not in unmatched]
+                if not live:
+                    break
+                pool(pending[name][0] for name in live)
+                for name in live:
+                    key = pending[name].pop(0)
+                    eucl_result[key], _cosine = evaluate_kernel(db, key, _pooled_maps[key],
+                                                                cosine=key not in cosine_result)
+                    if _cosine is not None:
+                        cosine_result[key] = _cosine
+                    if eucl_result[key][0] == 0:
+                        unmatched.add(name)
+            matched = [name for name in pending if name not in unmatched]
+            if len(matched) == 1:
+                if verbose:
+                    print(f"cascade: '{matched[0]}' is the only shape with 100 % euclidian confidence, "
+                          f"{len(eucl_result)} of {len(kernels)} kernels evaluated")
+                return {'euclidian': {matched[0]: 1.0}, 'cosine': cosine_sums, 'verdict': matched[0]}
+
+            remaining = [key for keys in pending.values() for key in keys]
+            pool(remaining)
+            for key in remaining:
+                eucl_result[key], _cosine = evaluate_kernel(db, key, _pooled_maps[key], cosine=key not in cosine_result)
+                if _cosine is not None:
+                    cosine_result[key] = _cosine
+        shape_results = {}
+        for shape in filters.shapes:
+            shape_results[shape['name']] = shape_result({key: eucl_result[key] for key in shape['filters']},
+                                                        {key: cosine_result[key] for key in shape['filters']},
+                                                        shape, verbose)
+        with profiler.span("verdict"):
+            _verdict = vd.verdict({name: result['cosine'] for name, result in shape_results.items()},
+                                  {name: result['euclidian'] for name, result in shape_results.items()})
+    return {
+        'euclidian': {name: result['euclidian'] for name, result in shape_results.items()},
+        'cosine': {name: result['cosine'] for name, result in shape_results.items()},
+        'verdict': _verdict
+    }
+
 # the more random changes comparing the trained data, the more
 # low confidence, even if the values are 10x higher than trained data,
 # if follows the trend of trained data, than is OK
@@ -0,0 +1,310 @@
+"""
+Stage level micro-benchmarks of the analysis pipeline, on synthetic images
+and a synthetic trained set held by an in-memory storage, (no database)
+usage:
+  python benchmark.py [--images N] [--size WxH] [--trained-rows N] [--repeat N]
+                      [--save baseline.json] [--compare baseline.json] [--threshold percent]
+the results are written to a json baseline with --save; --compare runs the
+benchmarks again and fails when a stage is slower than the baseline by more
+than the threshold
+"""
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+import numpy as np
+from PIL import Image, ImageDraw
+import analyzer as ana
+import cache
+import cnn
+import convolution
+import filters
+import main
+import pooling
+import precision
+import storage
+import verdict as vd
+from trained_store import TrainedDataStore
+
+REDUCED_WIDTH = main.REDUCED_WIDTH
+BENCHMARK_IMAGES = 8
+BENCHMARK_SIZE = "225x225"
+BENCHMARK_TRAINED_ROWS = 2000
+BENCHMARK_REPEAT = 5
+# allowed slow down of a stage median before it is reported as a regression, (percent)
+REGRESSION_THRESHOLD = 25.0
+SEED = 1234
+
+class MemoryStorage(storage.StorageInterface):
+    """
+    in-memory stand-in for the database, same interface as the storage
+    backends; the packed rows are kept in a dict, without transactions
+    """
+    def __init__(self):
+        super().__init__()
+        self._rows = {}
+
+    def database_connect(self):
+        pass
+
+    def database_disconnect(self):
+        pass
+
+    def get_matrices(self, keys):
+        return {key: storage.unpack_samples([row[3] for row in self._rows.get(key, [])]) for key in keys}
+
+    def iter_matrices(self, key, chunk_rows):
+        rows = self._rows.get(key, [])
+        for start in range(0, len(rows), chunk_rows):
+            yield storage.unpack_samples([row[3] for row in rows[start:start + chunk_rows]])
+
+    def insert_data(self, key, data):
+        row_index = sum(1 for row in self._rows.get(key, []) if row[0] is None)
+        self._rows.setdefault(key, []).append((None, None, row_index, storage.pack_samples(data)))
+
+    def copy_rows(self, key, rows):
+        self._rows.setdefault(key, []).extend(
+            (source, content_hash, row_index, storage.pack_samples(samples))
+            for samples, source, content_hash, row_index in rows)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def create_table(self, key):
+        self._rows[key] = []
+
+    def prepare_table(self, key):
+        self._rows[key] = [row for row in self._rows.get(key, []) if row[0] is not None]
+
+    def get_sources(self, key):
+        return {row[0]: row[1] for row in self._rows.get(key, [])}
+
+    def delete_source(self, key, source):
+        self._rows[key] = [row for row in self._rows.get(key, []) if row[0] != source]
+
+def synthetic_image(rng, width, height) -> bytes:
+    """
+    returns the png content of a digit like image: dark strokes on a light background
+    """
+    image = Image.new('RGB', (width, height), (245, 245, 245))
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.integers(2, 5)):
+        points = [(int(rng.integers(0, width)), int(rng.integers(0, height))) for _ in range(3)]
+        draw.line(points, fill=(20, 20, 20), width=int(rng.integers(8, 20)))
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+def synthetic_trained_set(db, pooled_maps, rows, rng) -> None:
+    """
+    fill the storage with rows per kernel drawn around the pooled maps of the
+    synthetic images, so part of the euclidian comparisons match
+    @param db: storage interface
+    @param pooled_maps: list of {kernel key: pooled map}, one per image
+    @param rows: number of trained rows per kernel
+    """
+    for key in pooled_maps[0]:
+        db.create_table(key)
+        samples = np.concatenate([np.asarray(pooled[key], dtype=np.float64) for pooled in pooled_maps])
+        picked = samples[rng.integers(0, len(samples), rows)]
+        noisy = picked * rng.normal(1.0, 0.1, picked.shape)
+        db.copy_rows(key, [(row, f"synthetic{i}.png", None, 0) for i, row in enumerate(noisy)])
+    db.commit()
+
+def measure(func, repeat, number) -> dict:
+    """
+    time a function, returns the median and min time of one operation
+    @param func: function running number operations
+    @param repeat: number of timed runs
+    @param number: number of operations run by one call of func
+    """
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) / number)
+    return {'median': statistics.median(times), 'min': min(times), 'number': number}
+
+class Benchmark:
+    """
+    class preparing the synthetic inputs and timing each stage
+    """
+    def __init__(self, images, size, trained_rows, repeat) -> None:
+        width, height = (int(value) for value in size.split('x'))
+        self.config = {'images': images, 'size': size, 'trained_rows': trained_rows, 'width': REDUCED_WIDTH}
+        self._repeat = repeat
+        rng = np.random.default_rng(SEED)
+        self._contents = [synthetic_image(rng, width, height) for _ in range(images)]
+        self._engine = convolution.default_engine()
+        self._engine.resolve_backend()
+        self._kernels = self._engine.keys()
+        self._normalized = []
+        for content in self._contents:
+            conv_nn = cnn.ConvolutionNN(io.BytesIO(content))
+            conv_nn.pre_processing(REDUCED_WIDTH)
+            self._normalized.append(conv_nn.normalized_array())
+        self._feature_maps = self._engine.convolve(self._normalized[0])
+        self._activated = [np.maximum(0, feature_map) for feature_map in self._feature_maps]
+        # pooled maps of each image, {kernel key: pooled map}
+        self._pooled = []
+        for content in self._contents:
+            with cnn.ImageProcessor(io.BytesIO(content), REDUCED_WIDTH) as img_proc:
+                img_proc.pre_processing()
+                shape_maps = img_proc.process_shapes(filters.shapes)
+            self._pooled.append({key: pooled for maps in shape_maps.values() for key, pooled in maps.items()})
+        self._db = MemoryStorage()
+        synthetic_trained_set(self._db, self._pooled, trained_rows, rng)
+        self._db.load_trained_data()
+        self._trained = self._db.trained_data()
+        # all the kernels quantized, whatever the number of trained rows
+        self._quantized = self._trained.quantized('uint8', 0)
+        shape_names = [shape['name'] for shape in filters.shapes]
+        self._results = [({name: rng.uniform(5.0, 7.0) for name in shape_names},
+                           {name: rng.integers(0, 7) / 6 for name in shape_names}) for _ in range(1000)]
+
+    def pre_processing(self) -> None:
+        for content in self._contents:
+            cnn.ConvolutionNN(io.BytesIO(content)).pre_processing(REDUCED_WIDTH)
+
+    def convolution(self) -> None:
+        for normalized in self._normalized:
+            self._engine.convolve(normalized)
+
+    def max_pooling2d(self) -> None:
+        max_pooling = pooling.get_backend()
+        for activated in self._activated:
+            max_pooling(activated, filters.pool_size, filters.stride)
+
+    def activate_and_pool(self) -> None:
+        conv_nn = cnn.ConvolutionNN(None)
+        for feature_map in self._feature_maps:
+            conv_nn.activate_and_pool(feature_map, filters.pool_size, filters.stride)
+
+    def load_trained_data(self) -> None:
+        # decode and index the trained set, without the load report
+        TrainedDataStore(self._db.get_matrices(self._kernels))
+
+    def evaluate_cosine(self) -> None:
+        for pooled in self._pooled:
+            for key in self._kernels:
+                with ana.Cosine(self._trained.get_trained_matrix(key), pooled[key],
+                                self._trained.get_trained_norms(key)) as cosine:
+                    cosine.evaluate_cosine()
+
+    def evaluate_euclidian(self) -> None:
+        for pooled in self._pooled:
+            for key in self._kernels:
+                with ana.Euclidian(self._trained.get_trained_matrix(key), pooled[key],
+                                   self._trained.get_trained_norms(key), self._trained.get_norm_index(key)) as eucl:
+                    eucl.evaluate_euclidian()
+
+    def evaluate_quantized_cosine(self) -> None:
+        for pooled in self._pooled:
+            for key in self._kernels:
+                with ana.Cosine(self._quantized.get_trained_matrix(key), pooled[key],
+                                self._quantized.get_trained_norms(key), self._quantized.get_quantized(key)) as cosine:
+                    cosine.evaluate_cosine()
+
+    def evaluate_quantized_euclidian(self) -> None:
+        for pooled in self._pooled:
+            for key in self._kernels:
+                with ana.Euclidian(self._quantized.get_trained_matrix(key), pooled[key],
+                                   self._quantized.get_trained_norms(key), self._quantized.get_norm_index(key),
+                                   self._quantized.get_quantized(key)) as eucl:
+                    eucl.evaluate_euclidian()
+
+    def verdict(self) -> None:
+        for cosine_result, eucl_result in self._results:
+            vd.verdict(cosine_result, eucl_result)
+
+    def analyse_image(self) -> None:
+        for content in self._contents:
+            ana.analyse_image(io.BytesIO(content), self._trained, REDUCED_WIDTH)
+
+    def analyse_images(self) -> None:
+        ana.analyse_images([io.BytesIO(content) for content in self._contents], self._trained, REDUCED_WIDTH)
+
+    def run(self) -> dict:
+        """
+        time all the stages, returns a map of stage name to timings
+        """
+        images = len(self._contents)
+        kernel_evaluations = images * len(self._kernels)
+        stages = [
+            ('pre_processing', self.pre_processing, images),
+            ('convolution', self.convolution, images),
+            ('max_pooling2d', self.max_pooling2d, len(self._activated)),
+            ('activate_and_pool', self.activate_and_pool, len(self._feature_maps)),
+            ('load_trained_data', self.load_trained_data, 1),
+            ('evaluate_cosine', self.evaluate_cosine, kernel_evaluations),
+            ('evaluate_euclidian', self.evaluate_euclidian, kernel_evaluations),
+            ('evaluate_quantized_cosine', self.evaluate_quantized_cosine, kernel_evaluations),
+            ('evaluate_quantized_euclidian', self.evaluate_quantized_euclidian, kernel_evaluations),
+            ('verdict', self.verdict, len(self._results)),
+            ('analyse_image', self.analyse_image, images),
+            ('analyse_images', self.analyse_images, images),
+        ]
+        return {name: measure(func, self._repeat, number) for name, func, number in stages}
+
+def environment() -> dict:
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'pooling_backend': pooling.DEFAULT_BACKEND, 'convolution_backend': convolution.default_engine().backend,
+            'reduced_decoding': cnn.REDUCED_DECODING, 'fused_pooling': pooling.FUSED_CASCADE,
+            'precision': precision.PRECISION}
+
+def show(stages, baseline=None, threshold=REGRESSION_THRESHOLD) -> list:
+    """
+    print the stage timings, compared to the baseline when provided;
+    returns the names of the stages slower than the threshold
+    """
+    regressions = []
+    print(f"{'stage':<30}{'median':>14}{'min':>14}{'baseline':>14}{'change':>10}")
+    for name, timing in stages.items():
+        line = f"{name:<30}{timing['median'] * 1e3:>12.4f}ms{timing['min'] * 1e3:>12.4f}ms"
+        if baseline is not None and name in baseline:
+            reference = baseline[name]['median']
+            change = (timing['median'] / reference - 1) * 100
+            line += f"{reference * 1e3:>12.4f}ms{change:>+9.1f}%"
+            if change > threshold:
+                line += "  ❌ regression"
+                regressions.append(name)
+        print(line)
+    return regressions
+
+if __name__ == "__main__":
+    images = int(main.pop_option("--images", BENCHMARK_IMAGES))
+    size = main.pop_option("--size", BENCHMARK_SIZE)
+    trained_rows = int(main.pop_option("--trained-rows", BENCHMARK_TRAINED_ROWS))
+    repeat = int(main.pop_option("--repeat", BENCHMARK_REPEAT))
+    save_path = main.pop_option("--save")
+    compare_path = main.pop_option("--compare")
+    threshold = float(main.pop_option("--threshold", REGRESSION_THRESHOLD))
+    # the caches would time file reads instead of the stages
+    cache.IMAGE_CACHE_ENABLED = False
+    cache.FEATURE_CACHE_ENABLED = False
+
+    baseline = None
+    if compare_path is not None:
+        with open(compare_path) as f:
+            baseline = json.load(f)
+
+    benchmark = Benchmark(images, size, trained_rows, repeat)
+    if baseline is not None and baseline['config'] != benchmark.config:
+        print(f"❌ The baseline was recorded with {baseline['config']}, current run {benchmark.config}")
+        sys.exit(1)
+    stages = benchmark.run()
+    regressions = show(stages, baseline['stages'] if baseline else None, threshold)
+
+    if save_path is not None:
+        with open(save_path, 'w') as f:
+            json.dump({'config': benchmark.config, 'environment': environment(), 'stages': stages}, f, indent=2)
+        print(f"✅ Baseline written to '{save_path}'.")
+    if regressions:
+        print(f"❌ {len(regressions)} stage(s) slower than the baseline by more than {threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,165 @@
+"""
+Module implementing content addressed on-disk caches of arrays:
+ - the pre-processed image arrays, (resized, gray-scale, inverted)
+ - the pooled maps per (image, kernel) pair
+entries are .npy files loaded memory-mapped, the least recently
+used entries are evicted once a cache exceeds its size limit
+"""
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+# set CNN_IMAGE_CACHE=0 or CNN_FEATURE_CACHE=0 to disable a cache
+IMAGE_CACHE_ENABLED = os.environ.get("CNN_IMAGE_CACHE", "1") != "0"
+FEATURE_CACHE_ENABLED = os.environ.get("CNN_FEATURE_CACHE", "1") != "0"
+CACHE_DIR = os.environ.get("CNN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+# max size of each cache in mega bytes
+CACHE_SIZE = int(os.environ.get("CNN_CACHE_SIZE", "512"))
+
+def read_content(image) -> bytes:
+    """
+    returns the raw content of an image
+    @param image: path to the image file or a binary file object
+    """
+    if hasattr(image, 'read'):
+        content = image.read()
+        image.seek(0)
+        return content
+    with open(image, 'rb') as f:
+        return f.read()
+
+def content_hash(content) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+def kernel_hash(kernel) -> str:
+    """
+    returns a short hash of a kernel matrix
+    @param kernel: kernel pattern
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    return hashlib.sha256(str(kernel.shape).encode() + kernel.tobytes()).hexdigest()[:16]
+
+def image_key(digest, width, version) -> str:
+    """
+    @param digest: content hash of the image file
+    @param width: image width to resize
+    @param version: pre-processing version
+    """
+    return f"{digest}-w{width}-v{version}"
+
+def feature_key(image_digest, kernel, pool_size, pool_stride, width, version) -> str:
+    """
+    @param image_digest: content hash of the image file
+    @param kernel: kernel pattern
+    @param pool_size: the size of the pooling array
+    @param pool_stride: the stride of max pooling
+    @param width: image width to resize
+    @param version: pre-processing version
+    """
+    return f"{image_digest}-k{kernel_hash(kernel)}-p{pool_size}-s{pool_stride}-w{width}-v{version}"
+
+class ArrayCache:
+    """
+    class storing one array per key, keys start with a content hash
+    """
+    def __init__(self, directory, max_bytes) -> None:
+        """
+        @param directory: cache directory, created on first write
+        @param max_bytes: size limit of the cache
+        """
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._size = None
+
+    def entry_path(self, key) -> str:
+        return os.path.join(self._directory, key[:2], key + ".npy")
+
+    def get(self, key):
+        """
+        returns the memory-mapped array of a key or None on a cache miss
+        @param key: entry key
+        """
+        path = self.entry_path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        try:
+            # refresh the entry for the LRU eviction, (a read-only cache still serves the hit)
+            os.utime(path)
+        except OSError:
+            pass
+        return array
+
+    def put(self, key, array) -> None:
+        """
+        store an array; the entry is written to a temporary file first
+        so concurrent readers never see a partial entry
+        @param key: entry key
+        @param array: array to store
+        """
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(tmp_path, path)
+        if self._size is None:
+            self._size = sum(size for _, _, size in self.entries())
+        else:
+            self._size += os.path.getsize(path)
+        if self._size > self._max_bytes:
+            self.evict()
+
+    def entries(self) -> list:
+        """
+        returns (last use time, path, size) for all the cache entries
+        """
+        entries = []
+        if not os.path.isdir(self._directory):
+            return entries
+        for sub_dir in os.scandir(self._directory):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.endswith(".npy"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def evict(self) -> None:
+        """
+        remove the least recently used entries until the cache fits
+        """
+        entries = sorted(self.entries())
+        self._size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self._size <= self._max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self._size -= size
+
+_caches = {}
+
+def get_cache(name, enabled):
+    if not enabled:
+        return None
+    if name not in _caches:
+        _caches[name] = ArrayCache(os.path.join(CACHE_DIR, name), CACHE_SIZE * 1024 * 1024)
+    return _caches[name]
+
+def image_cache():
+    """
+    returns the pre-processed image cache, None if disabled
+    """
+    return get_cache("images", IMAGE_CACHE_ENABLED)
+
+def feature_cache():
+    """
+    returns the pooled feature cache, None if disabled
+    """
+    return get_cache("features", FEATURE_CACHE_ENABLED)
@@ -1,18 +1,86 @@
-from PIL import Image, ImageOps
+import io
+import math
+import os
+import sys
+import time
+from collections import namedtuple
+from PIL import Image, ImageOps, UnidentifiedImageError
 import numpy as np
 from scipy.signal import convolve2d
-from tensorflow.keras.layers import MaxPooling2D
 import filters
+import pooling
+import convolution
+import cache
+import precision
+import profiler
+
+# bump when the pre-processing output changes, invalidates the image and feature caches
+PREPROCESSING_VERSION = 1
+# the activated maps are pooled until they are at most this wide
+POOLED_WIDTH = 5
+# CNN_REDUCED_DECODING=1 decodes the JPEG files at the reduced scale closest to the target
+# size, (DCT scaling), and as gray-scale only; off by default, the few gray levels it moves
+# change verdicts whose cosine sums are close to the gate, (verdict.COSINE_THRESHOLD)
+REDUCED_DECODING = os.environ.get("CNN_REDUCED_DECODING", "0") != "0"
+
+def preprocessing_version() -> str:
+    """
+    returns the pre-processing version of the cache keys, the reduced decoding
+    gives slightly different arrays so its cache entries are kept apart
+    """
+    if REDUCED_DECODING:
+        return f"{PREPROCESSING_VERSION}-reduced"
+    return str(PREPROCESSING_VERSION)
+
+def feature_version() -> str:
+    """
+    returns the version of the feature cache keys, the pooled maps
+    also depend on the precision of the convolution, (precision.py), and
+    on the convolution backend, (their rounding differs)
+    """
+    version = preprocessing_version()
+    if precision.compute_dtype() != np.float64:
+        version = f"{version}-{precision.PRECISION}"
+    return f"{version}-{convolution.default_engine().resolve_backend()}"
+
+def thumbnail_size(image_size, size):
+    """
+    returns the size of the image once resized by Image.thumbnail, (same
+    rounding), or None when the image is not larger than size
+    @param image_size: (width, height) of the image
+    @param size: (width, height) bounding box
+    """
+    x, y = size
+    width, height = image_size
+    if x >= width and y >= height:
+        return None
+    aspect = width / height
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return x, y
+
+# pre-processed image, (resized, gray-scale, inverted array), with the content hash of its file;
+# accepted in place of an image path so decoding and processing can run in different stages
+DecodedImage = namedtuple("DecodedImage", ["name", "array", "digest"])
 
 class ConvolutionNN:
-    def __init__(self, image_path, verbose=False):
+    def __init__(self, image_path, verbose=False, pooling_backend=None):
         self._image_path = image_path
         self._image = None
         self._array = None
+        self._digest = None
+        self._normalized_array = None
         self._verbose = verbose
         self._pooled_map = None
         self._kernel = None
         self._activated_map = None
+        self._max_pooling = pooling.get_backend(pooling_backend)
 
     def kernel_load(self, array):
         """
@@ -23,19 +91,67 @@ class ConvolutionNN:
 
     def pre_processing(self, width=128):
         """
-        resize image, convert to gray-scale
+        resize image, convert to gray-scale; the result is read from
+        the image cache when the same content was already processed
         @param width: image width to resize
         """
-        self._image = Image.open(self._image_path)
+        if isinstance(self._image_path, DecodedImage):
+            self._array = self._image_path.array
+            self._digest = self._image_path.digest
+            return
+        if self._verbose:
+            self.decode(self._image_path, width)
+            return
+        with profiler.span("read"):
+            content = cache.read_content(self._image_path)
+            self._digest = cache.content_hash(content)
+        images = cache.image_cache()
+        key = cache.image_key(self._digest, width, preprocessing_version())
+        with profiler.span("image_cache"):
+            self._array = images.get(key) if images else None
+        if self._array is None:
+            self.decode(io.BytesIO(content), width)
+            try:
+                if images:
+                    with profiler.span("image_cache_put"):
+                        images.put(key, self._array)
+            except OSError:
+                # the cache is best effort, e.g. read-only file system
+                pass
+
+    def decode(self, image, width):
+        """
+        decode the image, resize it and convert to gray-scale
+        @param image: path to the image file or a binary file object
+        @param width: image width to resize
+        """
+        with profiler.span("open"):
+            try:
+                self._image = Image.open(image)
+            except UnidentifiedImageError as e:
+                # the file content is decoded from memory, name the file instead of the buffer
+                name = self._image_path if isinstance(self._image_path, (str, os.PathLike)) else "<data>"
+                raise UnidentifiedImageError(f"cannot identify image file '{os.fspath(name)}'") from e
         ratio = self._image.width / width
-        self._image.thumbnail((width, round(self._image.height/ratio)), Image.Resampling.LANCZOS)
+        size = (width, round(self._image.height/ratio))
+        final_size = thumbnail_size(self._image.size, size)
+        with profiler.span("decode_resize"):
+            # JPEG: the decoder reduces the image by 1/2, 1/4 or 1/8, keeping it at least
+            # as large as the final size, the box maps the reduced image to the original
+            drafted = self._image.draft('L', final_size) if REDUCED_DECODING and final_size else None
+            if drafted is not None:
+                self._image = self._image.resize(final_size, Image.Resampling.LANCZOS, box=drafted[1])
+            else:
+                # the file is decoded by thumbnail, (reduced by the decoder when possible), then resized
+                self._image.thumbnail(size, Image.Resampling.LANCZOS)
         """
         convert to grayscale, 255 levels
         0 = black, 255 = white
         """
-        image = self._image.convert('L')
-        image = ImageOps.invert(image)
-        self._array = np.array(image)
+        with profiler.span("grayscale"):
+            image = self._image.convert('L')
+            image = ImageOps.invert(image)
+            self._array = np.array(image)
         image_rows, image_cols = self._array.shape
         if self._verbose:
             print("initial image matrix")
@@ -43,6 +159,12 @@ class ConvolutionNN:
             image.show()
             print(self._array)
 
+    def digest(self):
+        """
+        returns the content hash of the image, None in verbose mode
+        """
+        return self._digest
+
     def print_array(self, text, array):
         """
         display an array
@@ -53,15 +175,22 @@ class ConvolutionNN:
 
     def max_pooling2d(self, pool_size, pool_stride):
         """
-        apply max pooling to the activated map using the keras layer
+        apply max pooling to the activated map using the selected backend,
+        see pooling.py
         @pool_size: the size, (width and height) of the pooling array
         @pool_stride: value to shift on the right and down on each step of max pooling
         """
-        h, w = self._activated_map.shape
-        act_map = self._activated_map.reshape(1, h, w, 1)
-        max_pool = MaxPooling2D(pool_size=(pool_size, pool_size), strides=pool_stride, padding='same')
-        pooled_map = max_pool(act_map)
-        return pooled_map.numpy().squeeze()
+        with profiler.span("max_pooling2d"):
+            return self._max_pooling(self._activated_map, pool_size, pool_stride)
+
+    def normalized_array(self):
+        """
+        returns the image scaled to [0, 1] in the selected precision, computed once per image
+        """
+        if self._normalized_array is None:
+            self._normalized_array = np.true_divide(self._array, 255.0, dtype=precision.compute_dtype())
+            self.print_array("Normalized image matrix", self._normalized_array)
+        return self._normalized_array
 
     def process(self, pool_size, pool_stride):
         """
@@ -70,40 +199,79 @@ class ConvolutionNN:
         param @pool_size: the size, (width and height) of the pooling array
         param @pool_stride: value to shift on the right and down on each step of max pooling
         """
-        normalized_array = self._array/255.0
-        self.print_array("Normalized image matrix", normalized_array)
-        feature_map = convolve2d(normalized_array, self._kernel, mode='valid')
+        with profiler.span("convolve2d"):
+            feature_map = convolve2d(self.normalized_array(), self._kernel.astype(precision.compute_dtype()), mode='valid')
+        return self.activate_and_pool(feature_map, pool_size, pool_stride)
+
+    def fused_pooling(self, pool_size, pool_stride):
+        """
+        returns True when the pooling cascade runs as one reduction, (see pooling.CascadePlan);
+        the verbose mode displays the maps of every level and the keras backend is the reference
+        """
+        return (pooling.FUSED_CASCADE and not self._verbose and pool_size >= pool_stride
+                and self._max_pooling is pooling.numpy_max_pooling2d)
+
+    def activate_and_pool(self, feature_map, pool_size, pool_stride):
+        """
+        apply ReLU and max_pooling on a feature map until the
+        pooled map is at most 5 columns wide; ReLU is applied in place
+        param @feature_map: convolution output for the current kernel, or a stack
+                            of feature maps of the same size, (..., height, width)
+        param @pool_size: the size, (width and height) of the pooling array
+        param @pool_stride: value to shift on the right and down on each step of max pooling
+        """
+        if self.fused_pooling(pool_size, pool_stride):
+            with profiler.span("pooling_cascade"):
+                plan = pooling.cascade_plan(feature_map.shape[-2:], pool_size, pool_stride, POOLED_WIDTH)
+                self._pooled_map = plan.max_pool(feature_map)
+                # ReLU keeps the order of the values, it is applied to the pooled cells only
+                np.maximum(self._pooled_map, 0, out=self._pooled_map)
+            return self._pooled_map
+
         self.print_array("Feature map", feature_map)
     
-        # apply RE LU activation function
-        self._activated_map = np.maximum(0, feature_map)
+        # apply RE LU activation function, the feature map is not used anymore
+        self._activated_map = np.maximum(feature_map, 0, out=feature_map)
         self.print_array("Activated map", self._activated_map)
 
         self._pooled_map = self.max_pooling2d(pool_size, pool_stride)
         self.print_array("Pooled map", self._pooled_map)
 
-        h_pool, w_pool = self._pooled_map.shape
-        while w_pool > 5:
+        w_pool = self._pooled_map.shape[-1]
+        while w_pool > POOLED_WIDTH:
             self._activated_map = self._pooled_map
             """
             re-apply max pooling
             """
             self._pooled_map = self.max_pooling2d(pool_size, pool_stride)
             self.print_array("Pooled map", self._pooled_map)
-            h_pool, w_pool = self._pooled_map.shape
+            w_pool = self._pooled_map.shape[-1]
 
         return self._pooled_map
 
+def decode_image(image_path, width) -> DecodedImage:
+    """
+    returns the pre-processed image, (see ConvolutionNN.pre_processing)
+    @param image_path: path to the image file
+    @param width: image width to resize
+    """
+    conv_nn = ConvolutionNN(image_path)
+    conv_nn.pre_processing(width)
+    return DecodedImage(str(image_path), conv_nn._array, conv_nn.digest())
+
 """
 Wrapper class over ConvolutionNN
 """
 class ImageProcessor:
-    def __init__(self, image_path, width, verbose=False):
+    def __init__(self, image_path, width, verbose=False, pooling_backend=None):
         self._image_path = image_path
         self._verbose = verbose
+        self._pooling_backend = pooling_backend
         self._reduce_width = width
         self._engine = None
         self._shape_pooled_maps = {}
+        self._planned = []
+        self._feature_maps = {}
 
     def __enter__(self):
         return self
@@ -111,13 +279,15 @@ class ImageProcessor:
     def __exit__(self, exc_type, exc_val, exc_tb):
         del self._engine
         del self._shape_pooled_maps
+        del self._feature_maps
 
     def pre_processing(self):
         """
         Pre-process the image: resize, grayscale, invert if needed
         """
-        self._engine = ConvolutionNN(self._image_path, self._verbose)
-        self._engine.pre_processing(self._reduce_width)
+        with profiler.span("pre_processing"):
+            self._engine = ConvolutionNN(self._image_path, self._verbose, self._pooling_backend)
+            self._engine.pre_processing(self._reduce_width)
 
     def process(self, shape):
         """
@@ -125,11 +295,263 @@ class ImageProcessor:
         returns a map of pooled outputs for each kernel shape
         @param shape : a shape dictionary from filters.py
         """
-        self._shape_pooled_maps = {}
-        kernel_hash = shape['filters']
-        for key in kernel_hash:
-            self._engine.kernel_load(kernel_hash[key])
-            # run the convolution algorithm per kernel
-            self._shape_pooled_maps[key] = self._engine.process(filters.pool_size, filters.stride)
+        self._shape_pooled_maps = self.pooled_maps(shape['filters'])
         return self._shape_pooled_maps
 
+    def process_shapes(self, shapes):
+        """
+        Process the image with the kernels of several shapes in one pass;
+        returns a map of shape name to the pooled outputs for each kernel
+        @param shapes : list of shape dictionaries from filters.py
+        """
+        kernel_hash = {}
+        for shape in shapes:
+            kernel_hash.update(shape['filters'])
+        pooled_maps = self.pooled_maps(kernel_hash)
+        return {shape['name']: {key: pooled_maps[key] for key in shape['filters']} for shape in shapes}
+
+    def plan(self, keys):
+        """
+        announce the kernels which may be computed by the next calls, they are
+        convolved in the same batch as the first computed ones; the feature
+        maps are kept until their kernel is pooled
+        @param keys: kernel names
+        """
+        self._planned = list(keys)
+
+    def pooled_maps(self, kernel_hash):
+        """
+        returns the pooled outputs for each kernel, the (image, kernel) pairs
+        found in the feature cache are not computed again
+        @param kernel_hash: map of kernel name to kernel matrix
+        """
+        pooled_maps = {}
+        features = cache.feature_cache() if self._engine.digest() else None
+        feature_keys = {}
+        if features:
+            version = feature_version()
+            with profiler.span("feature_cache", kernels=len(kernel_hash)):
+                for key in kernel_hash:
+                    feature_keys[key] = cache.feature_key(self._engine.digest(), kernel_hash[key], filters.pool_size,
+                                                          filters.stride, self._reduce_width, version)
+                    pooled_map = features.get(feature_keys[key])
+                    if pooled_map is not None:
+                        pooled_maps[key] = pooled_map
+        missing = {key: kernel_hash[key] for key in kernel_hash if key not in pooled_maps}
+        if not missing:
+            return pooled_maps
+        computed = self.compute(missing)
+        pooled_maps.update(computed)
+        if features:
+            try:
+                with profiler.span("feature_cache_put", kernels=len(computed)):
+                    for key, pooled_map in computed.items():
+                        features.put(feature_keys[key], pooled_map)
+            except OSError:
+                # the cache is best effort, e.g. read-only file system
+                pass
+        return {key: pooled_maps[key] for key in kernel_hash}
+
+    def compute(self, kernel_hash):
+        """
+        run the convolution algorithm for each kernel; the kernels from
+        filters.py are convolved in one batched pass
+        @param kernel_hash: map of kernel name to kernel matrix
+        """
+        pooled_maps = {}
+        conv_engine = convolution.default_engine()
+        batched = [key for key in kernel_hash if key in conv_engine]
+        missing = [key for key in batched if key not in self._feature_maps]
+        if missing:
+            missing += [key for key in self._planned
+                        if key in conv_engine and key not in self._feature_maps and key not in missing]
+            with profiler.span("convolution", kernels=len(missing), backend=conv_engine.backend):
+                self._feature_maps.update(zip(missing, conv_engine.convolve(self._engine.normalized_array(), missing)))
+        for key in batched:
+            feature_map = self._feature_maps.pop(key)
+            with profiler.span("activate_and_pool", kernel=key):
+                pooled_maps[key] = self._engine.activate_and_pool(feature_map, filters.pool_size, filters.stride)
+        for key in kernel_hash:
+            if key not in conv_engine:
+                # kernel not part of filters.shapes, run the convolution algorithm per kernel
+                self._engine.kernel_load(kernel_hash[key])
+                with profiler.span("process", kernel=key):
+                    pooled_maps[key] = self._engine.process(filters.pool_size, filters.stride)
+        return pooled_maps
+
+"""
+Batched counterpart of ImageProcessor
+"""
+class BatchProcessor:
+    def __init__(self, images, width, pooling_backend=None):
+        """
+        process several images at once: the images of the same size, (the
+        width is fixed by the resize, the height varies), are stacked and go
+        through the convolution, ReLU and max pooling as one (images, height,
+        width) array; the pooled maps are the same as with ImageProcessor
+        @param images: paths to the image files or cnn.DecodedImage
+        @param width: image width to resize
+        """
+        self._images = images
+        self._pooling_backend = pooling_backend
+        self._reduce_width = width
+        self._engines = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        del self._engines
+
+    def pre_processing(self):
+        """
+        Pre-process the images: resize, grayscale, invert if needed
+        """
+        with profiler.span("pre_processing", images=len(self._images)):
+            for image in self._images:
+                engine = ConvolutionNN(image, pooling_backend=self._pooling_backend)
+                engine.pre_processing(self._reduce_width)
+                self._engines.append(engine)
+
+    def process_shapes(self, shapes):
+        """
+        Process the images with the kernels of several shapes;
+        returns, for each image, a map of shape name to the pooled outputs for each kernel
+        @param shapes : list of shape dictionaries from filters.py
+        """
+        kernel_hash = {}
+        for shape in shapes:
+            kernel_hash.update(shape['filters'])
+        return [{shape['name']: {key: pooled_maps[key] for key in shape['filters']} for shape in shapes}
+                for pooled_maps in self.pooled_maps(kernel_hash)]
+
+    def buckets(self, indices) -> list:
+        """
+        returns the image indices grouped by image size
+        @param indices: indices of the images to group
+        """
+        buckets = {}
+        for i in indices:
+            buckets.setdefault(self._engines[i].normalized_array().shape, []).append(i)
+        return list(buckets.values())
+
+    def pooled_maps(self, kernel_hash):
+        """
+        returns the pooled outputs for each kernel of each image, the (image,
+        kernel) pairs found in the feature cache are not computed again
+        @param kernel_hash: map of kernel name to kernel matrix
+        """
+        pooled_maps = [{} for _ in self._engines]
+        features = cache.feature_cache()
+        feature_keys = [{} for _ in self._engines]
+        if features:
+            version = feature_version()
+            with profiler.span("feature_cache", kernels=len(kernel_hash), images=len(self._engines)):
+                for i, engine in enumerate(self._engines):
+                    if not engine.digest():
+                        continue
+                    for key in kernel_hash:
+                        feature_keys[i][key] = cache.feature_key(engine.digest(), kernel_hash[key], filters.pool_size,
+                                                                 filters.stride, self._reduce_width, version)
+                        pooled_map = features.get(feature_keys[i][key])
+                        if pooled_map is not None:
+                            pooled_maps[i][key] = pooled_map
+        missing = [i for i in range(len(self._engines)) if len(pooled_maps[i]) < len(kernel_hash)]
+        if not missing:
+            return pooled_maps
+        computed = self.compute(missing, kernel_hash)
+        for i in missing:
+            computed_maps = {key: computed[i][key] for key in kernel_hash if key not in pooled_maps[i]}
+            pooled_maps[i].update(computed_maps)
+            if not feature_keys[i]:
+                continue
+            try:
+                with profiler.span("feature_cache_put", kernels=len(computed_maps)):
+                    for key, pooled_map in computed_maps.items():
+                        features.put(feature_keys[i][key], pooled_map)
+            except OSError:
+                # the cache is best effort, e.g. read-only file system
+                pass
+        return [{key: maps[key] for key in kernel_hash} for maps in pooled_maps]
+
+    def compute(self, indices, kernel_hash):
+        """
+        run the convolution algorithm for each kernel on the given images;
+        returns {image index: {kernel name: pooled map}}; the kernels from
+        filters.py are convolved, activated and pooled in one pass per bucket
+        of images of the same size
+        @param indices: indices of the images to process
+        @param kernel_hash: map of kernel name to kernel matrix
+        """
+        pooled_maps = {i: {} for i in indices}
+        conv_engine = convolution.default_engine()
+        batched = [key for key in kernel_hash if key in conv_engine]
+        for bucket in self.buckets(indices) if batched else []:
+            stack = np.stack([self._engines[i].normalized_array() for i in bucket])
+            with profiler.span("convolution", kernels=len(batched), images=len(bucket), backend=conv_engine.backend):
+                feature_maps = conv_engine.convolve(stack, batched)
+            with profiler.span("activate_and_pool", kernels=len(batched), images=len(bucket)):
+                pooled = self._engines[bucket[0]].activate_and_pool(feature_maps, filters.pool_size, filters.stride)
+            for i, image_pooled in zip(bucket, pooled):
+                pooled_maps[i].update(zip(batched, image_pooled))
+        for key in kernel_hash:
+            if key in conv_engine:
+                continue
+            # kernel not part of filters.shapes, run the convolution algorithm per image and kernel
+            for i in indices:
+                self._engines[i].kernel_load(kernel_hash[key])
+                with profiler.span("process", kernel=key):
+                    pooled_maps[i][key] = self._engines[i].process(filters.pool_size, filters.stride)
+        return pooled_maps
+
+if __name__ == "__main__":
+    """
+    fidelity check of the reduced decoding: the images are pre-processed with
+    and without it, the arrays are compared with today's full decoding
+    usage: python cnn.py [image files or folders]
+    """
+    paths = []
+    for path in sys.argv[1:]:
+        if os.path.isdir(path):
+            paths += sorted(os.path.join(path, name) for name in os.listdir(path))
+        else:
+            paths.append(path)
+    if not paths:
+        print("Usage python cnn.py [image files or folders]")
+        sys.exit(1)
+
+    def decode_time(path, repeat=5):
+        best = None
+        for _ in range(repeat):
+            _start = time.perf_counter()
+            ConvolutionNN(path).decode(path, 128)
+            _elapsed = time.perf_counter() - _start
+            best = _elapsed if best is None else min(best, _elapsed)
+        return best
+
+    print(f"{'image':<28}{'size':>12}{'full ms':>10}{'reduced ms':>12}{'max diff':>10}{'mean diff':>11}")
+    total_full = total_reduced = 0.0
+    for path in paths:
+        arrays = {}
+        timings = {}
+        for reduced in (False, True):
+            REDUCED_DECODING = reduced
+            conv_nn = ConvolutionNN(path)
+            try:
+                conv_nn.decode(path, 128)
+            except Exception as e:
+                print(f"{os.path.basename(path):<28}skipped: {e}")
+                break
+            arrays[reduced] = conv_nn._array.astype(np.int16)
+            timings[reduced] = decode_time(path)
+        else:
+            size = "x".join(str(value) for value in Image.open(path).size)
+            total_full += timings[False]
+            total_reduced += timings[True]
+            if arrays[False].shape != arrays[True].shape:
+                diff = f"{'shape ' + str(arrays[True].shape):>21}"
+            else:
+                delta = np.abs(arrays[False] - arrays[True])
+                diff = f"{delta.max():>10}{delta.mean():>11.3f}"
+            print(f"{os.path.basename(path):<28}{size:>12}{timings[False] * 1e3:>10.2f}{timings[True] * 1e3:>12.2f}{diff}")
+    print(f"total decode time {total_full * 1e3:.1f} ms full, {total_reduced * 1e3:.1f} ms reduced")
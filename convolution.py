@@ -0,0 +1,191 @@
+"""
+Module implementing a batched multi-kernel convolution engine;
+all the kernels from filters.py are stacked in one tensor and the
+image is convolved against all of them in a single pass
+supported backends:
+ - direct: scipy convolve2d per kernel, the reference implementation
+ - gemm: im2col followed by one matrix product
+ - fft: image spectrum multiplied by the cached kernel spectra
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft as sp_fft
+from scipy.signal import convolve2d
+import filters
+import precision
+
+BACKENDS = ('direct', 'gemm', 'fft')
+# the backends round differently, so the backend is fixed by default, (CNN_CONV_BACKEND);
+# 'auto' calibrates on first use, the fastest backend may then differ between machines
+CONV_BACKEND = os.environ.get("CNN_CONV_BACKEND", "gemm")
+# number of input sizes for which the kernel spectra are kept
+SPECTRA_CACHE_SIZE = 8
+# input size used for the one-time calibration, (height, width)
+CALIBRATION_SHAPE = (160, 128)
+
+class MultiKernelConvolution:
+    """
+    class convolving one image, or a stack of images of the same size,
+    against a stack of kernels, mode='valid' like scipy.signal.convolve2d
+    """
+    def __init__(self, kernels, backend='auto', dtype=np.float64) -> None:
+        """
+        @param kernels: dictionary of kernel name to kernel matrix
+        @param backend: 'direct', 'gemm', 'fft' or 'auto' to calibrate on first use
+        @param dtype: float32 or float64, the images are convolved in this precision
+        """
+        if backend != 'auto' and backend not in BACKENDS:
+            raise ValueError(f"unknown convolution backend '{backend}', expected 'auto' or one of {BACKENDS}")
+        self._keys = list(kernels)
+        self._index = {key: i for i, key in enumerate(self._keys)}
+        self.dtype = np.dtype(dtype)
+        self._kernels = np.array([kernels[key] for key in self._keys], dtype=self.dtype)
+        if self._kernels.ndim != 3:
+            raise ValueError("all kernels must have the same size")
+        # true convolution flips the kernel, the gemm backend correlates
+        self._flipped = np.ascontiguousarray(self._kernels[:, ::-1, ::-1])
+        self._spectra = OrderedDict()
+        # im2col buffer of the gemm backend, reused by the next image of the same size
+        self._scratch = threading.local()
+        self.backend = backend
+
+    def keys(self) -> list:
+        return self._keys
+
+    def index(self, key) -> int:
+        return self._index[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._index
+
+    def convolve_direct(self, image, indices=slice(None)):
+        if image.ndim == 3:
+            return np.stack([self.convolve_direct(single, indices) for single in image])
+        return np.stack([convolve2d(image, kernel, mode='valid') for kernel in self._kernels[indices]])
+
+    def convolve_gemm(self, image, indices=slice(None)):
+        flipped = self._flipped[indices]
+        n, kh, kw = flipped.shape
+        windows = sliding_window_view(image, (kh, kw), axis=(-2, -1))
+        out_h, out_w = windows.shape[-4:-2]
+        columns = self.columns_buffer(windows.shape)
+        np.copyto(columns, windows)
+        # one matrix product per image of a stack, so the rounding does not depend on the stack size
+        columns = columns.reshape(windows.shape[:-4] + (out_h * out_w, kh * kw))
+        feature_maps = flipped.reshape(n, kh * kw) @ np.swapaxes(columns, -1, -2)
+        return feature_maps.reshape(feature_maps.shape[:-1] + (out_h, out_w))
+
+    def columns_buffer(self, shape):
+        """
+        returns the im2col buffer of the current thread for a windows shape,
+        it is only reallocated when the image size changes
+        @param shape: shape of the sliding windows view, ([images,] height, width, kh, kw)
+        """
+        columns = getattr(self._scratch, 'columns', None)
+        if columns is None or columns.shape != shape:
+            columns = np.empty(shape, dtype=self.dtype)
+            self._scratch.columns = columns
+        return columns
+
+    def kernel_spectra(self, image_shape) -> tuple:
+        """
+        returns the fft size and the kernel spectra for an input size,
+        the spectra are computed once and cached per input size
+        @param image_shape: (height, width) of the input image
+        """
+        if image_shape in self._spectra:
+            self._spectra.move_to_end(image_shape)
+            return self._spectra[image_shape]
+        _, kh, kw = self._kernels.shape
+        fft_shape = (sp_fft.next_fast_len(image_shape[0] + kh - 1, real=True),
+                     sp_fft.next_fast_len(image_shape[1] + kw - 1, real=True))
+        spectra = (fft_shape, sp_fft.rfft2(self._kernels, s=fft_shape))
+        self._spectra[image_shape] = spectra
+        if len(self._spectra) > SPECTRA_CACHE_SIZE:
+            self._spectra.popitem(last=False)
+        return spectra
+
+    def convolve_fft(self, image, indices=slice(None)):
+        h, w = image.shape[-2:]
+        _, kh, kw = self._kernels.shape
+        fft_shape, spectra = self.kernel_spectra((h, w))
+        image_spectrum = sp_fft.rfft2(image, s=fft_shape)[..., None, :, :]
+        full = sp_fft.irfft2(image_spectrum * spectra[indices], s=fft_shape)
+        return full[..., kh - 1:h, kw - 1:w]
+
+    def calibrate(self, image_shape=CALIBRATION_SHAPE, repeat=3) -> str:
+        """
+        time every backend once on a random image and keep the fastest
+        @param image_shape: (height, width) of the calibration image
+        @param repeat: number of runs per backend, the best one is kept
+        """
+        image = np.random.default_rng(0).random(image_shape).astype(self.dtype)
+        timings = {}
+        for backend in BACKENDS:
+            convolve = getattr(self, "convolve_" + backend)
+            convolve(image)
+            best = None
+            for _ in range(repeat):
+                _start = time.perf_counter()
+                convolve(image)
+                _elapsed = time.perf_counter() - _start
+                best = _elapsed if best is None else min(best, _elapsed)
+            timings[backend] = best
+        self.backend = min(timings, key=timings.get)
+        return self.backend
+
+    def resolve_backend(self) -> str:
+        """
+        returns the backend used by convolve, calibrated first when 'auto'
+        """
+        if self.backend == 'auto':
+            self.calibrate()
+        return self.backend
+
+    def convolve(self, image, keys=None):
+        """
+        convolve the image against all the kernels, or only the given ones,
+        returns a (kernels, height, width) tensor of feature maps; a stack of
+        images of the same size is convolved in one pass and returns a
+        (images, kernels, height, width) tensor
+        @param image: 2D normalized image or (images, height, width) stack
+        @param keys: kernel names to apply, None for all the kernels
+        """
+        self.resolve_backend()
+        image = np.asarray(image, dtype=self.dtype)
+        indices = slice(None) if keys is None else [self._index[key] for key in keys]
+        return getattr(self, "convolve_" + self.backend)(image, indices)
+
+# engines per precision, (precision.py)
+_default_engines = {}
+
+def default_engine() -> MultiKernelConvolution:
+    """
+    returns the engine built over all the kernels of filters.shapes in the
+    selected precision and with the configured backend, shared between images
+    so the calibration and spectra are reused
+    """
+    dtype = precision.compute_dtype()
+    if dtype not in _default_engines:
+        kernels = {}
+        for shape in filters.shapes:
+            kernels.update(shape['filters'])
+        _default_engines[dtype] = MultiKernelConvolution(kernels, CONV_BACKEND, dtype)
+    return _default_engines[dtype]
+
+if __name__ == "__main__":
+    """
+    compare all backends against the reference and show the calibration
+    """
+    engine = default_engine()
+    print(f"precision {engine.dtype}, configured backend '{engine.backend}'")
+    image = np.random.default_rng(1).random(CALIBRATION_SHAPE).astype(engine.dtype)
+    reference = engine.convolve_direct(image)
+    for backend in BACKENDS:
+        result = getattr(engine, "convolve_" + backend)(image)
+        print(f"backend '{backend}' max abs error {np.max(np.abs(result - reference)):.3e}")
+    print(f"calibrated backend '{engine.calibrate()}'")
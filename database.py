@@ -1,9 +1,32 @@
 import psycopg2
+import io
 import sys
 import filters
+import profiler
+from storage import StorageInterface, open_storage, pack_samples, group_samples, fetch_chunks
+from storage import BULK_BATCH_SIZE, SAMPLES_TABLE
 
-class DataBaseInterface():
+# samples table columns, one row per pooled row of a kernel; source and content_hash
+# record the training image, samples holds the packed float64 values
+TABLE_COLUMNS = ("kernel TEXT NOT NULL, source TEXT, content_hash TEXT, row_index INTEGER NOT NULL, "
+                 "samples BYTEA NOT NULL, UNIQUE (kernel, source, row_index)")
+SAMPLES_COLUMNS = "kernel, source, content_hash, row_index, samples"
+
+def copy_text(value):
+    """
+    returns a value in the COPY text format
+    """
+    if value is None:
+        return "\\N"
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+class DataBaseInterface(StorageInterface):
+    """
+    postgres backend, the samples of a row are stored in a BYTEA column,
+    see storage.StorageInterface
+    """
     def __init__(self, hostname, database, username, password, port):
+        super().__init__()
         self._host = hostname
         self._database = database
         self._user = username
@@ -11,17 +34,7 @@ class DataBaseInterface():
         self._port = port
         self._connection = None
         self._cursor = None
-        self._trained_data = {}
-
-    def __enter__(self):
-        if self.database_connect() is False:
-            print("❌ Error connecting to database")
-            sys.exit(1)
-        return self
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-         self.database_disconnect()
-         del self._trained_data
+        self._named_cursors = 0
 
     def database_connect(self):
         try:
@@ -47,45 +60,139 @@ class DataBaseInterface():
         if self._connection:
             self._connection.close()
 
-    def get_data(self, table_name):
-        self._cursor.execute("SELECT samples FROM " + table_name)
-        rows = self._cursor.fetchall()
-        return rows
+    def missing_samples_table(self):
+        """
+        returns the error raised when the samples table does not exist, the
+        failed statement aborted the transaction so it is rolled back first
+        """
+        self._connection.rollback()
+        legacy = self.legacy_tables()
+        if legacy:
+            return ValueError(f"table '{SAMPLES_TABLE}' does not exist, the trained data is still stored in "
+                              f"{len(legacy)} per-kernel tables, run 'python database.py --migrate' first")
+        return ValueError(f"table '{SAMPLES_TABLE}' does not exist, train the kernels first, "
+                          "(or run 'python database.py --migrate' for a database of per-kernel tables)")
 
-    def insert_data(self, table_name, data):
-        self._cursor.execute("INSERT INTO " + table_name + " (samples) VALUES (%s)", (data,))
-        self._connection.commit()
+    def get_matrices(self, keys):
+        with profiler.span("fetch_trained_data", backend='postgres'):
+            try:
+                self._cursor.execute(f"SELECT kernel, samples FROM {SAMPLES_TABLE} WHERE kernel = ANY(%s) "
+                                     "ORDER BY kernel, source, row_index", (list(keys),))
+            except psycopg2.errors.UndefinedTable:
+                raise self.missing_samples_table() from None
+            rows = self._cursor.fetchall()
+        with profiler.span("decode_trained_data"):
+            return group_samples(keys, rows)
 
-    def create_table(self, table_name):
-        drop_table_query = f"DROP TABLE IF EXISTS {table_name} CASCADE;"
-        self._cursor.execute(drop_table_query)
-        print(f"✅ Table '{table_name}' dropped successfully.")
-        create_table_query = f"CREATE TABLE {table_name} (samples DOUBLE PRECISION[]);"
-        self._cursor.execute(create_table_query)
-        print(f"✅ Table '{table_name}' created successfully.")
-        self._connection .commit()
+    def iter_matrices(self, key, chunk_rows):
+        # server-side cursor, the rows are transferred chunk_rows at a time
+        self._named_cursors += 1
+        cursor = self._connection.cursor(name=f"samples_{self._named_cursors}")
+        cursor.itersize = chunk_rows
+        try:
+            cursor.execute(f"SELECT samples FROM {SAMPLES_TABLE} WHERE kernel = %s ORDER BY source, row_index", (key,))
+        except psycopg2.errors.UndefinedTable:
+            # the cursor was never declared, closing it would fail in the rolled back transaction
+            raise self.missing_samples_table() from None
+        with cursor:
+            yield from fetch_chunks(cursor, chunk_rows)
+
+    def insert_data(self, key, data):
+        self._cursor.execute(f"INSERT INTO {SAMPLES_TABLE} (kernel, row_index, samples) "
+                             f"SELECT %s, COALESCE(MAX(row_index) + 1, 0), %s FROM {SAMPLES_TABLE} "
+                             "WHERE kernel = %s AND source IS NULL", (key, pack_samples(data), key))
+        self._connection.commit()
 
-    def load_trained_data(self):
+    def copy_rows(self, key, rows):
         """
-        Loads the all trained data from filters.py into memory
+        insert several rows with one COPY FROM STDIN, without commit
+        @param key: kernel key
+        @param rows: list of (samples, source, content hash, row index), samples as lists of floats
         """
-        for shape_index in range(len(filters.shapes)):
-            shape = filters.shapes[shape_index]
-            for key in shape['filters']:
-                self._trained_data[key] = self.get_data(key)
-        print("✅ Trained data loaded successfully.")
+        buffer = io.StringIO()
+        for samples, source, content_hash, row_index in rows:
+            buffer.write(copy_text(key) + "\t" + copy_text(source) + "\t" + copy_text(content_hash) + "\t"
+                         + str(row_index) + "\t\\\\x" + pack_samples(samples).hex() + "\n")
+        buffer.seek(0)
+        self._cursor.copy_expert(f"COPY {SAMPLES_TABLE} ({SAMPLES_COLUMNS}) FROM STDIN", buffer)
+
+    def commit(self):
+        self._connection.commit()
 
-    def get_trained_data(self, key):
+    def rollback(self):
+        self._connection.rollback()
+
+    def create_samples_table(self):
+        self._cursor.execute(f"CREATE TABLE IF NOT EXISTS {SAMPLES_TABLE} ({TABLE_COLUMNS});")
+
+    def create_table(self, key):
+        self.create_samples_table()
+        self._cursor.execute(f"DELETE FROM {SAMPLES_TABLE} WHERE kernel = %s", (key,))
+        print(f"✅ Samples of '{key}' removed successfully.")
+        self._connection.commit()
+
+    def prepare_table(self, key):
         """
-        Returns the trained data for a specific kernel key
+        prepare a kernel for incremental training, without commit; rows
+        without provenance can not be matched to a file, they are removed
+        and their files are processed again
         @param key: kernel key
         """
-        return self._trained_data[key]
+        self.create_samples_table()
+        self._cursor.execute(f"DELETE FROM {SAMPLES_TABLE} WHERE kernel = %s AND source IS NULL", (key,))
+
+    def get_sources(self, key):
+        self._cursor.execute(f"SELECT DISTINCT source, content_hash FROM {SAMPLES_TABLE} WHERE kernel = %s", (key,))
+        return dict(self._cursor.fetchall())
+
+    def delete_source(self, key, source):
+        self._cursor.execute(f"DELETE FROM {SAMPLES_TABLE} WHERE kernel = %s AND source = %s", (key, source))
+
+    def legacy_tables(self):
+        """
+        returns the kernel keys still stored in a per-kernel table,
+        (the schema before the samples table)
+        """
+        keys = [key for shape in filters.shapes for key in shape['filters']]
+        self._cursor.execute("SELECT table_name FROM information_schema.tables "
+                             "WHERE table_schema = current_schema() AND table_name = ANY(%s)", (keys,))
+        return [row[0] for row in self._cursor.fetchall()]
+
+    def migrate(self):
+        """
+        move the rows of the per-kernel DOUBLE PRECISION[] tables to the
+        samples table and drop them, in one transaction; the rows of a source
+        file are indexed in their storage order
+        """
+        self.create_samples_table()
+        for key in self.legacy_tables():
+            self._cursor.execute("SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() "
+                                 "AND table_name = %s AND column_name = 'source'", (key,))
+            provenance = "source, content_hash" if self._cursor.fetchone() else "NULL, NULL"
+            self._cursor.execute(f"DELETE FROM {SAMPLES_TABLE} WHERE kernel = %s", (key,))
+            row_indexes = {}
+            migrated = 0
+            with self._connection.cursor(name=f"migrate_{key}") as legacy:
+                legacy.execute(f"SELECT samples, {provenance} FROM {key} ORDER BY ctid")
+                while True:
+                    fetched = legacy.fetchmany(BULK_BATCH_SIZE)
+                    if not fetched:
+                        break
+                    rows = []
+                    for samples, source, content_hash in fetched:
+                        row_index = row_indexes.get(source, 0)
+                        row_indexes[source] = row_index + 1
+                        rows.append((samples, source, content_hash, row_index))
+                    self.copy_rows(key, rows)
+                    migrated += len(rows)
+            self._cursor.execute(f"DROP TABLE {key} CASCADE;")
+            print(f"✅ {migrated} rows of table '{key}' migrated to '{SAMPLES_TABLE}'.")
+        self._connection.commit()
 
 if __name__ == "__main__":
-    db = DataBaseInterface('localhost','myapp','postgres','password',5432)
-    db.database_connect()
-    res = db.get_data('digit_3_filter_1')
-    for row in res:
-        print("res=", row)
-    db.database_disconnect()
\ No newline at end of file
+    with open_storage('postgres') as db:
+        if "--migrate" in sys.argv:
+            db.migrate()
+        else:
+            for row in db.get_data('digit_3_filter_1'):
+                print("res=", row)
@@ -1,29 +1,87 @@
 import sys
 import os
 import time
+from functools import partial
 from pathlib import Path
 import filters
 import cnn
-import database as data
+import storage as data
 import analyzer as ana
-import verdict as vd
-from database import DataBaseInterface
+import cache
+import server
+import snapshot
+import profiler
+import pipeline
+import quantization
 
 REDUCED_WIDTH = 128
+# trained data and analyse mode of a process pool worker, see init_worker
+_worker_trained_data = None
+_worker_cascade = False
 
 def usage() -> None:
     print("Usage python main.py -d [image file], debug image processing steps")
     print("      python main.py -t [folder with images] [shape to train] train the model")
+    print("         --batch-size N, number of rows sent to the database in one batch")
+    print("         --incremental, only process new or changed images, remove the rows of deleted images")
+    print("         --jobs N, process the images with N processes, 0 for one process per cpu")
+    print("         --batch N, process N images at a time, the images of the same size are convolved together")
     print("      python main.py -a [image file | image_path], analyse mode, run all the filters and output a confidence percent")
+    print("         --jobs N, analyse the images of image_path with N processes, 0 for one process per cpu")
+    print("         --snapshot [snapshot file], memory-map the trained data from a snapshot instead of the database")
+    print("         --stream N, read the trained data N rows at a time for every image instead of loading it, (one process)")
+    print("         --profile [trace file], record the time and allocations of every stage to a chrome trace, (one process)")
+    print("         --cascade, stop evaluating an image once its verdict can not change anymore, (same verdicts)")
+    print("         --batch N, analyse the images of image_path N at a time, the images of the same size are")
+    print("           convolved together and the trained data is evaluated once per batch, (same results)")
+    print("      python main.py --serve [unix socket path] [http port], analyse daemon keeping the trained data loaded")
+    print("         --snapshot [snapshot file], memory-map the trained data from a snapshot instead of the database")
+    print("      python main.py --export-snapshot [snapshot file], write all the trained data to a snapshot file")
+    print("         --quantize uint8|float16, also write the samples quantized, the analysis reads the codes and")
+    print("           re-ranks the results the quantization error can change with the exact samples, (same results),")
+    print("           the exact samples stay in the file")
+    print(f"         --quantize-min-rows N, only quantize the kernels of at least N rows, "
+          f"({quantization.QUANTIZED_MIN_ROWS} by default)")
+    print("      CNN_STORAGE=postgres|sqlite selects the trained data storage, CNN_SQLITE_PATH the sqlite file")
     sys.exit(1)
 
+def pop_option(option, default=None):
+    """
+    remove an option and its value from the command line arguments,
+    returns the option value or default when not provided
+    @param option: option name, e.g. "--jobs"
+    @param default: value returned when the option is missing
+    """
+    if option not in sys.argv:
+        return default
+    index = sys.argv.index(option)
+    if index + 1 >= len(sys.argv):
+        usage()
+    value = sys.argv[index + 1]
+    del sys.argv[index:index + 2]
+    return value
+
+def pop_flag(flag) -> bool:
+    """
+    remove a flag from the command line arguments,
+    returns True when the flag was provided
+    @param flag: flag name, e.g. "--incremental"
+    """
+    if flag not in sys.argv:
+        return False
+    sys.argv.remove(flag)
+    return True
+
 def get_files_from_directory(directory):
     """
     @param: directory: Directory path
-    Generator to retrieve a list of files in the specified directory.
+    Generator to retrieve a list of files in the specified directory,
+    the names are yielded while the directory is read
     """
-    files_only = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
-    yield from files_only
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry.name
 
 def get_shape_dict(shape2match) -> int:
     """
@@ -37,45 +95,210 @@ def get_shape_dict(shape2match) -> int:
     print(f"Error: element to train '{shape2match}' not found")
     return None
     
-def process_and_analyse_image(image_path, db_if, verbose=False) -> None:
+def open_trained_data(snapshot_path):
+    """
+    returns the trained data source: the snapshot file when provided,
+    the configured storage backend otherwise
+    @param snapshot_path: snapshot file path or None
+    """
+    if snapshot_path is not None:
+        return snapshot.Snapshot(snapshot_path)
+    return data.open_storage()
+
+def analyse(image_path, trained_data, verbose=False, cascade=False) -> dict:
+    """
+    returns the analyse result of an image, see analyzer.analyse_image
+    @param cascade: use the cascaded evaluation, (analyzer.analyse_image_cascade)
+    """
+    if cascade:
+        return ana.analyse_image_cascade(image_path, trained_data, REDUCED_WIDTH, verbose)
+    return ana.analyse_image(image_path, trained_data, REDUCED_WIDTH, verbose)
+
+def process_and_analyse_image(image_path, db_if, verbose=False, cascade=False) -> None:
     """
     process and analyse a single image
     @param image_path: path to the image file
-    @param db: database interface
+    @param db: trained data, (trained_store.TrainedDataStore)
     @param verbose: verbose mode
+    @param cascade: use the cascaded evaluation
+    """
+    try:
+        result = analyse(image_path, db_if, verbose, cascade)
+    except Exception as e:
+        print(f"Unexpected exception during processing image '{image_path}': {e}")
+        return
+    print_result(image_path, result)
+
+def train_image(image_path, shape) -> dict:
+    """
+    process an image for training,
+    returns the pooled rows, (as lists), for each kernel of the shape
+    @param image_path: path to the image file or cnn.DecodedImage
+    @param shape: a shape dictionary from filters.py
+    """
+    with cnn.ImageProcessor(image_path, REDUCED_WIDTH, verbose=False) as img_processor:
+        img_processor.pre_processing()
+        _polled_map = img_processor.process(shape)
+        # convert from numpy array to list
+        return {key: [row.tolist() for row in values] for key, values in _polled_map.items()}
+
+def decode_worker(image_path) -> cnn.DecodedImage:
+    """
+    decode stage of the pipeline, run in the I/O threads
+    @param image_path: path to the image file
+    """
+    return cnn.decode_image(image_path, REDUCED_WIDTH)
+
+def train_worker(decoded, shape) -> tuple:
+    """
+    training compute stage of the pipeline, returns (content hash, pooled rows per kernel)
+    @param decoded: decoded image, (cnn.DecodedImage)
+    @param shape: a shape dictionary from filters.py
+    """
+    return decoded.digest, train_image(decoded, shape)
+
+def train_batch_worker(decoded_images, shape) -> list:
+    """
+    batched train_worker, the images are processed with cnn.BatchProcessor
+    @param decoded_images: decoded images, (cnn.DecodedImage)
+    @param shape: a shape dictionary from filters.py
+    """
+    with cnn.BatchProcessor(decoded_images, REDUCED_WIDTH) as batch_processor:
+        batch_processor.pre_processing()
+        pooled_maps = batch_processor.process_shapes([shape])
+    return [(decoded.digest, {key: [row.tolist() for row in values] for key, values in image_maps[shape['name']].items()})
+            for decoded, image_maps in zip(decoded_images, pooled_maps)]
+
+def training_provenance(content_hash) -> str:
+    """
+    returns the provenance stored with the rows of a training image: its content
+    hash and the version of the features, (cnn.feature_version), the rows depend
+    on the decoding, the precision and the convolution backend as well
+    @param content_hash: content hash of the training image
+    """
+    return f"{content_hash}:{cnn.feature_version()}"
+
+def get_training_images(image_path) -> list:
     """
-    eucl_result = {}
-    cosine_result = {}
-    with cnn.ImageProcessor(image_path, REDUCED_WIDTH, False) as img_proc:
-        try:
-            img_proc.pre_processing()
-            for shape in filters.shapes:
-                _pooled_map = img_proc.process(shape)
-                """
-                call the analyzer module
-                """
-                result = ana.evaluate(_pooled_map, shape, db_if, verbose)
-                """
-                fill all the results for verdict processing
-                """
-                eucl_result[shape['name']] = result['euclidian']
-                cosine_result[shape['name']] = result['cosine']
-                print(
-                    f"Euclidian evaluation confidence {round(result['euclidian'] * 100, 2)} % for {shape['name']}"
-                    )
-        except Exception as e:
-            print(f"Unexpected exception during processing image '{image_path}': {e}")
-            return
+    returns the (file name, provenance) pairs of a training folder, (see training_provenance)
+    @param image_path: path to the training images
+    """
+    return [(image, training_provenance(cache.content_hash(cache.read_content(image_path + "/" + image))))
+            for image in get_files_from_directory(image_path)]
+
+def plan_incremental_training(db, shape, image_path) -> list:
+    """
+    compare a training folder with the provenance stored for a shape;
+    the rows of removed and changed images, (content or feature version),
+    are deleted, (without commit), returns the (file name, provenance) pairs
+    to process
+    @param db: database interface
+    @param shape: a shape dictionary from filters.py
+    @param image_path: path to the training images
+    """
+    images = dict(get_training_images(image_path))
+    stored = {}
+    for key in shape['filters']:
+        db.prepare_table(key)
+        stored[key] = db.get_sources(key)
+    # an image is up to date when all the kernels hold its rows for the same content and features
+    to_process = [image for image, digest in images.items()
+                  if any(stored[key].get(image) != digest for key in stored)]
+    reprocessed = set(to_process)
+    removed = set()
+    for key in stored:
+        for source in stored[key]:
+            if source not in images or source in reprocessed:
+                db.delete_source(key, source)
+                if source not in images:
+                    removed.add(source)
+    print(f"✅ Incremental training for '{shape['name']}': {len(to_process)} new or changed, "
+          f"{len(removed)} removed, {len(images) - len(to_process)} unchanged images")
+    return [(image, images[image]) for image in to_process]
+
+def init_worker(trained_data, cascade=False) -> None:
+    """
+    process pool initializer, the trained data is received once per worker
+    @param trained_data: trained data store, (trained_store.TrainedDataStore)
+    @param cascade: use the cascaded evaluation
+    """
+    global _worker_trained_data, _worker_cascade
+    _worker_trained_data = trained_data
+    _worker_cascade = cascade
+
+def analyse_worker(decoded) -> dict:
+    """
+    analyse compute stage of the pipeline, run in this process
+    or in a process pool worker, (see init_worker)
+    @param decoded: decoded image, (cnn.DecodedImage)
+    """
+    return analyse(decoded, _worker_trained_data, cascade=_worker_cascade)
+
+def analyse_batch_worker(decoded_images) -> list:
+    """
+    batched analyse_worker, (analyzer.analyse_images)
+    @param decoded_images: decoded images, (cnn.DecodedImage)
+    """
+    return ana.analyse_images(decoded_images, _worker_trained_data, REDUCED_WIDTH)
+
+def print_analyse_result(image_path, result, error) -> None:
+    if error is not None:
+        print(f"Unexpected exception during processing image '{image_path}': {error}")
+    else:
+        print_result(image_path, result)
+    print()
 
+def analyse_directory(image_path, trained_data, jobs, cascade=False, batch=1) -> None:
+    """
+    analyse all the images of a directory with the streaming pipeline, (pipeline.py),
+    the images are decoded in I/O threads and analysed in this process or in a
+    process pool, the results are printed in the directory listing order
+    @param image_path: path to the images directory
+    @param trained_data: trained data, (trained_store.TrainedDataStore)
+    @param jobs: number of worker processes, 1 to analyse in this process
+    @param cascade: use the cascaded evaluation
+    @param batch: number of images analysed together, (analyzer.analyse_images)
+    """
+    if jobs <= 1:
+        init_worker(trained_data, cascade)
+    images = (image_path + "/" + image for image in get_files_from_directory(image_path))
+    worker = analyse_batch_worker if batch > 1 else analyse_worker
+    pipeline.run(images, decode_worker, worker, print_analyse_result, jobs, init_worker, (trained_data, cascade), batch)
+
+def print_result(image_path, result) -> None:
+    """
+    display the analyse result of an image
+    @param image_path: path to the image file
+    @param result: dict returned by analyzer.analyse_image
+    """
+    for name, confidence in result['euclidian'].items():
+        print(f"Euclidian evaluation confidence {round(confidence * 100, 2)} % for {name}")
+    if not result['euclidian']:
+        print("Euclidian evaluation skipped, the cosine evaluation can not reach the threshold")
     # issue verdict
     print("=====> Results")
-    print(f"--> Cosine evaluation '{max(cosine_result, key=cosine_result.get)}'")
-    res = vd.verdict(cosine_result, eucl_result)
-    print(f"'{res}' image in file '{image_path}'")
+    print(f"--> Cosine evaluation '{max(result['cosine'], key=result['cosine'].get)}'")
+    print(f"'{result['verdict']}' image in file '{image_path}'")
 
 if __name__ == "__main__":
+    jobs = int(pop_option("--jobs", 1)) or os.cpu_count()
+    batch_size = int(pop_option("--batch-size", data.BULK_BATCH_SIZE))
+    incremental = pop_flag("--incremental")
+    snapshot_path = pop_option("--snapshot")
+    stream_rows = int(pop_option("--stream", 0))
+    profile_path = pop_option("--profile")
+    cascade = pop_flag("--cascade")
+    batch = int(pop_option("--batch", 1))
+    quantize = pop_option("--quantize")
+    quantize_min_rows = int(pop_option("--quantize-min-rows", quantization.QUANTIZED_MIN_ROWS))
     if len(sys.argv) <= 2:
         usage()
+    if cascade and batch > 1:
+        print("Error: --cascade evaluates the images one at a time, it can not be used with --batch")
+        usage()
+    if quantize is not None and quantize not in quantization.QUANTIZATIONS:
+        print(f"Error: unknown quantization '{quantize}', expected one of {quantization.QUANTIZATIONS}")
+        usage()
 
     # load image path
     image_path = sys.argv[2]
@@ -102,19 +325,33 @@ if __name__ == "__main__":
 
     elif sys.argv[1] == "-a":
         _start = time.time()
-        with DataBaseInterface('localhost','myapp','postgres','password',5432) as db:
-            db.load_trained_data()
+        _profiler = profiler.Profiler() if profile_path else None
+        if _profiler:
+            # the spans are recorded in this process only
+            jobs = 1
+            _profiler.start()
+        with open_trained_data(snapshot_path) as db:
+            if stream_rows > 0 and snapshot_path is None:
+                # constant memory, the trained rows are read in chunks for every image
+                trained_data = data.StreamingTrainedData(db, stream_rows)
+                jobs = 1
+            else:
+                db.load_trained_data()
+                trained_data = db.trained_data()
             """
             check if image_path is a file or a directory
             """
             if Path(image_path).is_file():
-                process_and_analyse_image(image_path, db, verbose=True)
+                process_and_analyse_image(image_path, trained_data, verbose=True, cascade=cascade)
             elif Path(image_path).is_dir():
-                for image in get_files_from_directory(image_path):
-                    process_and_analyse_image(image_path + "/" + image, db, verbose=False)
-                    print()
+                analyse_directory(image_path, trained_data, jobs, cascade, batch)
             else:
                 print(f"Error: '{image_path}' is neither a valid file nor a directory")
+        if _profiler:
+            _profiler.stop()
+            _profiler.write_trace(profile_path)
+            _profiler.summary()
+            print(f"✅ Profile written to '{profile_path}'.")
         _end = time.time() - _start
         print(f"Analyse time: {_end:.4f}s")
 
@@ -130,26 +367,52 @@ if __name__ == "__main__":
         shape = get_shape_dict(sys.argv[3])
         if shape is None:
             usage()
-        # database connection
-        with data.DataBaseInterface('localhost','myapp','postgres','password',5432) as db:
-            # cleanup tables
-            for key in shape['filters'].keys():
-                db.create_table(key)
+        # storage connection, (CNN_STORAGE)
+        with data.open_storage() as db:
+            if incremental:
+                images = [image for image, _ in plan_incremental_training(db, shape, image_path)]
+            else:
+                # cleanup tables
+                for key in shape['filters'].keys():
+                    db.create_table(key)
+                images = get_files_from_directory(image_path)
             """
-            start processing all images in the specified folder
+            start processing the images of the specified folder with the streaming
+            pipeline, the shape is committed in one transaction
             """
-            for image in get_files_from_directory(image_path):
-                with cnn.ImageProcessor(image_path + "/" + image, REDUCED_WIDTH, verbose=False) as img_processor:
-                    try:
-                        img_processor.pre_processing()
-                        print("Processing image:", image)
-                        _polled_map = img_processor.process(shape)
-                        for key, values in _polled_map.items():
-                            for row in values:
-                                # convert from numpy array to list
-                                db.insert_data(key, row.tolist())
-                    except Exception as e:
-                        print(f"Unexpected exception during processing image '{image}': {e}")
-                        continue
+            with data.BulkWriter(db, batch_size) as writer:
+                def write_rows(image, result, error):
+                    if error is not None:
+                        print(f"Unexpected exception during processing image '{image}': {error}")
+                        return
+                    print("Processing image:", image)
+                    digest, pooled_rows = result
+                    for key, values in pooled_rows.items():
+                        writer.add(key, values, image, training_provenance(digest))
+
+                worker = partial(train_batch_worker if batch > 1 else train_worker, shape=shape)
+                pipeline.run(images, lambda image: decode_worker(image_path + "/" + image),
+                             worker, write_rows, jobs, batch=batch)
+
+    elif sys.argv[1] == "--serve":
+        http_port = int(sys.argv[3]) if len(sys.argv) > 3 else server.HTTP_PORT
+        with open_trained_data(snapshot_path) as db:
+            db.load_trained_data()
+            server.serve(db, image_path, http_port, REDUCED_WIDTH)
+
+    elif sys.argv[1] == "--export-snapshot":
+        with data.open_storage() as db:
+            db.load_trained_data()
+            trained_data = db.trained_data()
+            if quantize is not None:
+                trained_data = trained_data.quantized(quantize, quantize_min_rows)
+                if trained_data.quantized_kernels() == 0:
+                    print(f"❌ No kernel has at least {quantize_min_rows} rows, the snapshot is not quantized, "
+                          f"(--quantize-min-rows 0 quantizes all the kernels)")
+                else:
+                    print(f"✅ {trained_data.quantized_kernels()} of {len(trained_data.keys())} kernels quantized, "
+                          f"({quantize}, at least {quantize_min_rows} rows)")
+            snapshot.export(trained_data, image_path)
+        print(f"✅ Snapshot written to '{image_path}'.")
     else:
         usage()
@@ -0,0 +1,141 @@
+"""
+Module implementing the streaming pipeline of the directory modes, (-a and -t):
+ - the items are listed lazily, (os.scandir)
+ - decode: read, decode and resize in a pool of I/O threads
+ - compute: convolution and evaluation in the main thread or in a pool of processes,
+   one item or one batch of items at a time
+ - emit: the results are handed over in the listing order
+the stages are connected by bounded windows of pending items, a stage waits
+for the next one when its window is full so the memory use does not depend
+on the number of files, and the decoding of the next images overlaps the
+computation of the current ones
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import os
+
+# threads reading and decoding the images
+IO_THREADS = min(4, os.cpu_count() or 1)
+# decoded images waiting for the compute stage
+DECODE_AHEAD = 16
+# images being computed per compute process
+COMPUTE_AHEAD = 2
+
+class InlineExecutor:
+    """
+    compute stage of a single process, the work is done in the calling
+    thread when the result is requested, so the decode threads run ahead
+    """
+    class Result:
+        def __init__(self, func, args) -> None:
+            self._func = func
+            self._args = args
+
+        def result(self):
+            return self._func(*self._args)
+
+    def submit(self, func, *args) -> 'InlineExecutor.Result':
+        return InlineExecutor.Result(func, args)
+
+    def shutdown(self, wait=True, cancel_futures=False) -> None:
+        pass
+
+class Failed:
+    """
+    result of an item which failed before the compute stage
+    """
+    def __init__(self, error) -> None:
+        self._error = error
+
+    def result(self):
+        raise self._error
+
+def run(items, decode, compute, emit, jobs=1, initializer=None, initargs=(), batch=1) -> None:
+    """
+    run the items through the pipeline
+    @param items: iterable of items, e.g. file paths, consumed lazily
+    @param decode: function(item) returning the decoded item, run in the I/O threads
+    @param compute: function(decoded item) returning the result, run in the compute
+                    processes when jobs > 1, (it must be picklable); when batch > 1
+                    function(list of decoded items) returning the list of results
+    @param emit: function(item, result, error message) called in the listing order,
+                 result is None when decode or compute raised
+    @param jobs: number of compute processes, 1 to compute in the calling thread
+    @param initializer: compute process initializer
+    @param initargs: arguments of the compute process initializer
+    @param batch: number of decoded items handed to one compute call, the items of
+                  a batch which raised are computed again one by one so only the
+                  failing items emit an error
+    """
+    if jobs > 1:
+        computer = ProcessPoolExecutor(jobs, initializer=initializer, initargs=initargs)
+    else:
+        computer = InlineExecutor()
+    compute_ahead = COMPUTE_AHEAD * max(jobs, 1)
+    items = iter(items)
+    decoding = deque()
+    # (items, pending result, list of the decoded items of a batch or None for a single item)
+    computing = deque()
+    batched = []
+    with ThreadPoolExecutor(IO_THREADS, thread_name_prefix="decode") as decoder:
+        def fill():
+            while len(decoding) < DECODE_AHEAD:
+                item = next(items, None)
+                if item is None:
+                    return
+                decoding.append((item, decoder.submit(decode, item)))
+
+        def submit_batch():
+            if batched:
+                computing.append(([item for item, _ in batched],
+                                  computer.submit(compute, [decoded for _, decoded in batched]),
+                                  [decoded for _, decoded in batched]))
+                batched.clear()
+
+        try:
+            fill()
+            while decoding or computing or batched:
+                if computing and (len(computing) >= compute_ahead or not (decoding or batched)):
+                    pending_items, pending, batch_decoded = computing.popleft()
+                    try:
+                        results = pending.result()
+                        if batch_decoded is None:
+                            results = [results]
+                        outcomes = [(result, None) for result in results]
+                    except Exception as e:
+                        if batch_decoded is None or len(batch_decoded) == 1:
+                            outcomes = [(None, str(e))] * len(pending_items)
+                        else:
+                            # retry the items alone so one bad image does not fail the whole batch
+                            retries = [computer.submit(compute, [decoded]) for decoded in batch_decoded]
+                            outcomes = []
+                            for retry in retries:
+                                try:
+                                    outcomes.append((retry.result()[0], None))
+                                except Exception as e:
+                                    outcomes.append((None, str(e)))
+                    for item, (result, error) in zip(pending_items, outcomes):
+                        emit(item, result, error)
+                    continue
+                if not decoding:
+                    submit_batch()
+                    continue
+                item, pending = decoding.popleft()
+                fill()
+                try:
+                    decoded = pending.result()
+                except Exception as e:
+                    # keep the listing order, the error is emitted after the pending results
+                    submit_batch()
+                    computing.append(([item], Failed(e), None))
+                    continue
+                if batch > 1:
+                    batched.append((item, decoded))
+                    if len(batched) >= batch:
+                        submit_batch()
+                else:
+                    computing.append(([item], computer.submit(compute, decoded), None))
+        finally:
+            for _, pending in decoding:
+                pending.cancel()
+            computer.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,218 @@
+"""
+Module implementing 2D max pooling with keras padding='same' semantics
+the numpy engine is the default, tensorflow/keras is an optional backend;
+the cascade of max poolings of the numpy engine can be applied as one
+reduction over precomputed windows, (CascadePlan)
+"""
+import functools
+import math
+import os
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+def same_padding(size, pool_size, pool_stride) -> tuple:
+    """
+    returns (output size, padding before, padding after) for one axis,
+    following the tensorflow 'same' padding rules
+    @param size: input size on the axis
+    @param pool_size: the size of the pooling window
+    @param pool_stride: value to shift on each step of max pooling
+    """
+    out_size = math.ceil(size / pool_stride)
+    pad_total = max((out_size - 1) * pool_stride + pool_size - size, 0)
+    pad_before = pad_total // 2
+    return out_size, pad_before, pad_total - pad_before
+
+def numpy_max_pooling2d(array, pool_size, pool_stride):
+    """
+    strided window max reduction, bit-for-bit compatible with
+    keras MaxPooling2D(padding='same'); keras runs the layer in float32
+    so the result is float32 as well
+    @param array: 2D activated map, or a stack of maps of the same size, (..., height, width)
+    @param pool_size: the size, (width and height) of the pooling array
+    @param pool_stride: value to shift on the right and down on each step of max pooling
+    """
+    array = np.asarray(array, dtype=np.float32)
+    h, w = array.shape[-2:]
+    out_h, top, bottom = same_padding(h, pool_size, pool_stride)
+    out_w, left, right = same_padding(w, pool_size, pool_stride)
+    """
+    padded cells never win the max reduction
+    """
+    padding = [(0, 0)] * (array.ndim - 2) + [(top, bottom), (left, right)]
+    padded = np.pad(array, padding, constant_values=-np.inf)
+    windows = sliding_window_view(padded, (pool_size, pool_size), axis=(-2, -1))[..., ::pool_stride, ::pool_stride, :, :]
+    return windows[..., :out_h, :out_w, :, :].max(axis=(-2, -1))
+
+def keras_max_pooling2d(array, pool_size, pool_stride):
+    """
+    reference implementation using the keras layer, tensorflow is
+    imported on first use only
+    @param array: 2D activated map, or a stack of maps of the same size, (..., height, width)
+    @param pool_size: the size, (width and height) of the pooling array
+    @param pool_stride: value to shift on the right and down on each step of max pooling
+    """
+    from tensorflow.keras.layers import MaxPooling2D
+    array = np.asarray(array)
+    h, w = array.shape[-2:]
+    act_map = array.reshape(-1, h, w, 1)
+    max_pool = MaxPooling2D(pool_size=(pool_size, pool_size), strides=pool_stride, padding='same')
+    pooled = max_pool(act_map).numpy()[:, :, :, 0]
+    return pooled.reshape(array.shape[:-2] + pooled.shape[1:])
+
+BACKENDS = {
+    'numpy': numpy_max_pooling2d,
+    'keras': keras_max_pooling2d,
+}
+# 'numpy' built-in engine or 'keras', (requires tensorflow)
+DEFAULT_BACKEND = os.environ.get("CNN_POOLING_BACKEND", "numpy")
+# apply the cascade of max poolings as one reduction, CNN_FUSED_POOLING=0 pools level by level
+FUSED_CASCADE = os.environ.get("CNN_FUSED_POOLING", "1") != "0"
+# number of input sizes for which the cascade plans are kept
+PLAN_CACHE_SIZE = 64
+
+def get_backend(name=None):
+    """
+    returns the pooling function for a backend name
+    @param name: 'numpy', 'keras' or None for the default backend
+    """
+    if name is None:
+        name = DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"unknown pooling backend '{name}', expected one of {list(BACKENDS)}")
+    return BACKENDS[name]
+
+def cascade_windows(size, pool_size, pool_stride, levels) -> list:
+    """
+    returns the [start, end) input range of each cell of one axis after
+    several max poolings; the ranges of the windows of every level are
+    merged, they stay contiguous as long as pool_size >= pool_stride
+    @param size: input size on the axis
+    @param pool_size: the size of the pooling window
+    @param pool_stride: value to shift on each step of max pooling
+    @param levels: number of max poolings
+    """
+    starts = np.arange(size)
+    ends = starts + 1
+    for _ in range(levels):
+        out_size, before, _ = same_padding(len(starts), pool_size, pool_stride)
+        # first and last cell of each window, without the padded cells
+        first = np.arange(out_size) * pool_stride - before
+        last = np.minimum(first + pool_size - 1, len(starts) - 1)
+        starts, ends = starts[np.maximum(first, 0)], ends[last]
+    return list(zip(starts.tolist(), ends.tolist()))
+
+class CascadePlan:
+    """
+    window index map of a cascade of max poolings over one input size: the
+    maps are pooled until they are at most max_width columns wide, every
+    cell of the last level is the max of a rectangle of the input, (the
+    union of its windows at every level), so the cascade is computed as one
+    reduction without the intermediate pooled maps
+    """
+    def __init__(self, shape, pool_size, pool_stride, max_width) -> None:
+        """
+        @param shape: (height, width) of the input maps
+        @param pool_size: the size, (width and height) of the pooling array
+        @param pool_stride: value to shift on the right and down on each step of max pooling
+        @param max_width: the maps are pooled again while they are wider than max_width
+        """
+        if pool_size < pool_stride:
+            raise ValueError(f"pool_size {pool_size} smaller than the stride {pool_stride}, the windows are not contiguous")
+        height, width = shape
+        width = same_padding(width, pool_size, pool_stride)[0]
+        self.levels = 1
+        while width > max_width:
+            width = same_padding(width, pool_size, pool_stride)[0]
+            self.levels += 1
+        self.rows = cascade_windows(height, pool_size, pool_stride, self.levels)
+        self.columns = cascade_windows(shape[1], pool_size, pool_stride, self.levels)
+
+    def max_pool(self, array):
+        """
+        returns the maps pooled by the whole cascade, the same float32
+        result as numpy_max_pooling2d applied level by level
+        @param array: 2D map, or a stack of maps of the plan size, (..., height, width)
+        """
+        array = np.asarray(array)
+        columns = np.stack([array[..., start:end].max(axis=-1) for start, end in self.columns], axis=-1)
+        pooled = np.stack([columns[..., start:end, :].max(axis=-2) for start, end in self.rows], axis=-2)
+        # rounding to float32 keeps the order of the values, the max is the same before or after
+        return pooled.astype(np.float32)
+
+@functools.lru_cache(maxsize=PLAN_CACHE_SIZE)
+def cascade_plan(shape, pool_size, pool_stride, max_width) -> CascadePlan:
+    """
+    returns the cascade plan of an input size, computed once per size
+    """
+    return CascadePlan(tuple(shape), pool_size, pool_stride, max_width)
+
+def staged_cascade(array, pool_size, pool_stride, max_width):
+    """
+    reference of CascadePlan.max_pool, the numpy engine applied level by level
+    """
+    pooled = numpy_max_pooling2d(array, pool_size, pool_stride)
+    while pooled.shape[-1] > max_width:
+        pooled = numpy_max_pooling2d(pooled, pool_size, pool_stride)
+    return pooled
+
+def reference_max_pooling2d(array, pool_size, pool_stride):
+    """
+    plain loop reference of numpy_max_pooling2d, each output cell takes the
+    max of its window clipped to the map, (the padded cells never win the max)
+    @param array: 2D map
+    """
+    array = np.asarray(array, dtype=np.float32)
+    h, w = array.shape
+    out_h, top, _ = same_padding(h, pool_size, pool_stride)
+    out_w, left, _ = same_padding(w, pool_size, pool_stride)
+    pooled = np.empty((out_h, out_w), dtype=np.float32)
+    for i in range(out_h):
+        row = i * pool_stride - top
+        for j in range(out_w):
+            col = j * pool_stride - left
+            pooled[i, j] = array[max(row, 0):row + pool_size, max(col, 0):col + pool_size].max()
+    return pooled
+
+if __name__ == "__main__":
+    """
+    parity check of the numpy engine against a plain loop reference, of the
+    cascade plans against the numpy engine applied level by level, then of
+    the numpy engine against the keras layer when tensorflow is installed
+    """
+    import filters
+    rng = np.random.default_rng(0)
+    # a 3x3 map pooled by 2x2 windows of stride 2 is padded after, (the last row and column alone)
+    if not np.array_equal(numpy_max_pooling2d(np.arange(9.0).reshape(3, 3), 2, 2), [[4, 5], [7, 8]]):
+        print("❌ pooling mismatch for the 3x3 example")
+        raise SystemExit(1)
+    for pool_size, pool_stride in [(filters.pool_size, filters.stride), (2, 2), (3, 2), (3, 1)]:
+        for h, w in [(122, 122), (41, 41), (14, 15), (7, 9), (5, 5), (2, 3), (1, 1)]:
+            act_map = rng.normal(size=(h, w))
+            expected = reference_max_pooling2d(act_map, pool_size, pool_stride)
+            result = numpy_max_pooling2d(act_map, pool_size, pool_stride)
+            if expected.shape != result.shape or not np.array_equal(expected, result):
+                print(f"❌ reference mismatch for input {h}x{w}, pool {pool_size} stride {pool_stride}")
+                raise SystemExit(1)
+        print(f"✅ reference parity for pool {pool_size} stride {pool_stride}")
+    for h, w in [(122, 122), (90, 122), (61, 121), (300, 122), (41, 41), (14, 14), (7, 9), (5, 5)]:
+        feature_maps = rng.normal(size=(3, h, w))
+        expected = staged_cascade(feature_maps, filters.pool_size, filters.stride, 5)
+        result = cascade_plan((h, w), filters.pool_size, filters.stride, 5).max_pool(feature_maps)
+        if expected.shape != result.shape or not np.array_equal(expected, result):
+            print(f"❌ cascade mismatch for input {h}x{w}")
+            raise SystemExit(1)
+        print(f"✅ cascade parity for input {h}x{w} -> {result.shape[1]}x{result.shape[2]}")
+    try:
+        import tensorflow
+    except ImportError:
+        print("✅ tensorflow is not installed, keras parity check skipped")
+        raise SystemExit(0)
+    for h, w in [(122, 122), (157, 122), (41, 41), (14, 14), (7, 9), (5, 5)]:
+        act_map = np.maximum(0, rng.normal(size=(h, w)))
+        expected = keras_max_pooling2d(act_map, filters.pool_size, filters.stride)
+        result = numpy_max_pooling2d(act_map, filters.pool_size, filters.stride)
+        if expected.shape != result.shape or not np.array_equal(expected, result):
+            print(f"❌ pooling mismatch for input {h}x{w}")
+            raise SystemExit(1)
+        print(f"✅ pooling parity for input {h}x{w} -> {result.shape[0]}x{result.shape[1]}")
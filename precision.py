@@ -0,0 +1,72 @@
+"""
+Module selecting the floating point precision of the computations, (CNN_PRECISION):
+the normalized images, the convolution and the trained data held in memory are
+float32 by default, float64 is the reference; the pooled maps are float32 in
+both modes, (keras semantics), and the storage keeps the samples as float64
+usage: python precision.py [image folder], accuracy drift report of float32
+against float64 on the images of the folder, (test_images by default)
+"""
+import os
+import sys
+import time
+import numpy as np
+
+PRECISIONS = ('float32', 'float64')
+PRECISION = os.environ.get("CNN_PRECISION", "float32")
+
+def compute_dtype():
+    """
+    returns the numpy dtype of the selected precision
+    """
+    if PRECISION not in PRECISIONS:
+        raise ValueError(f"unknown precision '{PRECISION}', expected one of {PRECISIONS}")
+    return np.dtype(PRECISION)
+
+if __name__ == "__main__":
+    """
+    analyse the images in both precisions against the trained data of the
+    configured storage, (CNN_STORAGE), and compare the results
+    """
+    import cache
+    import filters
+    import main
+    import precision
+    import storage
+    from trained_store import TrainedDataStore
+    folder = sys.argv[1] if len(sys.argv) > 1 else "test_images"
+    images = sorted(os.path.join(folder, name) for name in os.listdir(folder))
+    # the pooled maps are computed in both precisions, not read from the cache
+    cache.FEATURE_CACHE_ENABLED = False
+    with storage.open_storage() as db:
+        matrices = db.get_matrices([key for shape in filters.shapes for key in shape['filters']])
+    results = {}
+    for name in ('float64', 'float32'):
+        precision.PRECISION = name
+        trained = TrainedDataStore(matrices)
+        results[name] = {}
+        _start = time.perf_counter()
+        for image in images:
+            try:
+                results[name][image] = main.analyse(image, trained)
+            except Exception as e:
+                print(f"'{image}' skipped: {e}")
+        _elapsed = time.perf_counter() - _start
+        print(f"{name}: trained data {trained.nbytes() / (1024 * 1024):.2f} MB, analyse time {_elapsed:.3f}s")
+
+    print(f"{'image':<28}{'float64':>18}{'float32':>18}{'cosine drift':>14}{'euclidian drift':>17}")
+    changes = 0
+    cosine_drift = euclidian_drift = 0.0
+    for image, reference in results['float64'].items():
+        result = results['float32'].get(image)
+        if result is None:
+            continue
+        cosine = max(abs(result['cosine'][name] - reference['cosine'][name]) for name in reference['cosine'])
+        euclidian = max(abs(result['euclidian'][name] - reference['euclidian'][name]) for name in reference['euclidian'])
+        cosine_drift = max(cosine_drift, cosine)
+        euclidian_drift = max(euclidian_drift, euclidian)
+        changed = result['verdict'] != reference['verdict']
+        changes += changed
+        print(f"{os.path.basename(image):<28}{reference['verdict']:>18}{result['verdict']:>18}{cosine:>14.2e}"
+              f"{euclidian:>17.2e}{'  ❌ verdict changed' if changed else ''}")
+    print(f"{changes} verdict change(s) on {len(results['float64'])} images, max cosine drift {cosine_drift:.2e}, "
+          f"max euclidian drift {euclidian_drift:.2e}")
@@ -0,0 +1,168 @@
+"""
+Module implementing the profiling of the analysis pipeline, (main.py -a ... --profile):
+the stages are wrapped in spans recording the wall time and the allocated bytes,
+(tracemalloc), with the image and kernel they belong to; the spans are written
+as a chrome trace, (chrome://tracing or https://ui.perfetto.dev), and summarized
+in tables. When no profiler is running span() returns a shared no-op context
+"""
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+_profiler = None
+
+class NoSpan:
+    """
+    context returned by span() when profiling is disabled
+    """
+    def __enter__(self) -> 'NoSpan':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        return False
+
+NO_SPAN = NoSpan()
+
+def span(name, **args):
+    """
+    returns a context recording a span of the running profiler
+    @param name: stage name
+    @param args: span details, e.g. image=..., kernel=...
+    """
+    if _profiler is None:
+        return NO_SPAN
+    return Span(_profiler, name, args)
+
+def enabled() -> bool:
+    return _profiler is not None
+
+class Span:
+    """
+    one timed stage; the allocation peak of a span includes the peaks of
+    its nested spans, tracemalloc only keeps one peak so it is reset at
+    every span boundary and propagated to the parent span
+    """
+    def __init__(self, profiler, name, args) -> None:
+        self._profiler = profiler
+        self._name = name
+        self._args = args
+        self._start = 0.0
+        self._memory = 0
+        self.peak = 0
+
+    def __enter__(self) -> 'Span':
+        stack = self._profiler.stack()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self._memory = tracemalloc.get_traced_memory()[0]
+        self.peak = self._memory
+        stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
+        end = time.perf_counter()
+        memory, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        stack = self._profiler.stack()
+        stack.pop()
+        if stack:
+            stack[-1].peak = max(stack[-1].peak, self.peak)
+        tracemalloc.reset_peak()
+        self._profiler.record(self._name, self._start, end, self._args,
+                              allocated=self.peak - self._memory, retained=memory - self._memory)
+        return False
+
+class Profiler:
+    """
+    class collecting the spans of all the threads of the process
+    """
+    def __init__(self) -> None:
+        self._origin = 0.0
+        self._local = threading.local()
+        self.events = []
+
+    def __enter__(self) -> 'Profiler':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        global _profiler
+        tracemalloc.start()
+        self._origin = time.perf_counter()
+        _profiler = self
+
+    def stop(self) -> None:
+        global _profiler
+        _profiler = None
+        tracemalloc.stop()
+
+    def stack(self) -> list:
+        """
+        returns the open spans of the current thread
+        """
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def record(self, name, start, end, args, allocated, retained) -> None:
+        self.events.append({
+            'name': name,
+            'ts': (start - self._origin) * 1e6,
+            'dur': (end - start) * 1e6,
+            'tid': threading.get_ident(),
+            'args': dict(args, allocated=allocated, retained=retained)
+        })
+
+    def write_trace(self, path) -> None:
+        """
+        write the spans in the chrome trace event format
+        @param path: trace file path
+        """
+        pid = os.getpid()
+        events = [dict(event, ph='X', cat='cnn', pid=pid) for event in self.events]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+    def totals(self, group) -> dict:
+        """
+        returns {group value: [spans, total time in us, max time in us, max allocated bytes]}
+        @param group: function returning the group of an event, None to skip it
+        """
+        totals = {}
+        for event in self.events:
+            key = group(event)
+            if key is None:
+                continue
+            total = totals.setdefault(key, [0, 0.0, 0.0, 0])
+            total[0] += 1
+            total[1] += event['dur']
+            total[2] = max(total[2], event['dur'])
+            total[3] = max(total[3], event['args']['allocated'])
+        return totals
+
+    def summary(self) -> None:
+        """
+        print the time and allocations per stage, per kernel and per image
+        """
+        tables = [
+            ("stage", lambda event: event['name']),
+            ("kernel", lambda event: event['args'].get('kernel')),
+            ("image", lambda event: event['args']['image'] if event['name'] == 'analyse_image' else None),
+        ]
+        for title, group in tables:
+            totals = self.totals(group)
+            if not totals:
+                continue
+            width = max(len(title), max(len(str(key)) for key in totals)) + 2
+            print(f"{title:<{width}}{'spans':>8}{'total ms':>12}{'mean ms':>12}{'max ms':>12}{'max alloc KB':>14}")
+            for key, (count, total, longest, allocated) in sorted(totals.items(), key=lambda item: -item[1][1]):
+                print(f"{str(key):<{width}}{count:>8}{total / 1e3:>12.3f}{total / count / 1e3:>12.3f}"
+                      f"{longest / 1e3:>12.3f}{allocated / 1024:>14.1f}")
+            print()
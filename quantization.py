@@ -0,0 +1,152 @@
+"""
+Module implementing the quantized trained data of the snapshots, (main.py
+--export-snapshot ... --quantize uint8|float16): the rows of a kernel divided
+by their norm are held as uint8 or float16 codes with one scale factor per
+kernel, row = code * scale * norm; the evaluations read the codes instead of
+the samples, (cast to floats block by block), the results the quantization
+error can change are computed again with the exact rows, (mapped from the
+snapshot, only these pages are read): the euclidian distances close to the
+threshold and the similarities which can still be the cosine max, so the
+results are the ones of the exact rows, (up to the rounding of the matrix
+product for the similarities); the kernels with fewer rows than
+QUANTIZED_MIN_ROWS stay exact, their samples fit the cpu cache
+usage: python quantization.py [image folder] [--min-rows N], accuracy and
+memory report of the quantized trained data against the exact one on the
+images of the folder, (test_images by default), --min-rows 0 quantizes all
+the kernels
+"""
+import os
+import sys
+import time
+import numpy as np
+
+QUANTIZATIONS = ('uint8', 'float16')
+UINT8_MAX = 255
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+# trained rows cast to floats at a time by QuantizedRows.dot, the block stays in the cpu cache
+DOT_BLOCK_ROWS = 4096
+# smaller kernels are evaluated faster from their exact samples
+QUANTIZED_MIN_ROWS = DOT_BLOCK_ROWS
+
+class QuantizedRows:
+    """
+    quantized samples of the trained rows of a kernel divided by their norm,
+    (unit rows), in the row order of the exact matrix
+    """
+    def __init__(self, codes, scale, error) -> None:
+        """
+        @param codes: (rows, samples) matrix of uint8 or float16 codes
+        @param scale: value of one code unit
+        @param error: max euclidian distance between an exact unit row and its
+                      dequantized codes, the distance to the exact row is then
+                      at most error * norm of the row
+        """
+        self.codes = codes
+        self.scale = scale
+        self.error = error
+
+    @property
+    def mode(self) -> str:
+        return self.codes.dtype.name
+
+    def dequantize(self, rows=slice(None), dtype=np.float32):
+        """
+        returns the dequantized unit rows
+        @param rows: index of the rows, all the rows by default
+        @param dtype: dtype of the samples
+        """
+        return self.codes[rows].astype(dtype) * np.dtype(dtype).type(self.scale)
+
+    def dot(self, pooled):
+        """
+        returns the dot products of the pooled rows with all the codes, (pooled
+        rows, trained rows), in code units, (* scale for the dequantized unit rows);
+        the codes are cast block by block into one small buffer, the samples are
+        never materialized as floats
+        @param pooled: (pooled rows, samples) matrix
+        """
+        products = np.empty((len(pooled), len(self.codes)), dtype=pooled.dtype)
+        block = np.empty((min(DOT_BLOCK_ROWS, len(self.codes)), self.codes.shape[1]), dtype=pooled.dtype)
+        for start in range(0, len(self.codes), DOT_BLOCK_ROWS):
+            end = min(start + DOT_BLOCK_ROWS, len(self.codes))
+            np.copyto(block[:end - start], self.codes[start:end], casting='unsafe')
+            np.matmul(pooled, block[:end - start].T, out=products[:, start:end])
+        return products
+
+def quantize(matrix, mode) -> QuantizedRows:
+    """
+    quantize the unit rows of a kernel, the scale maps the largest sample to
+    the largest code; the error is measured against the unit rows in float64
+    @param matrix: (rows, samples) matrix, in the precision of the evaluation
+    @param mode: quantization, one of QUANTIZATIONS
+    """
+    if mode not in QUANTIZATIONS:
+        raise ValueError(f"unknown quantization '{mode}', expected one of {QUANTIZATIONS}")
+    exact = np.asarray(matrix, dtype=np.float64)
+    norms = np.linalg.norm(exact, axis=1, keepdims=True)
+    # a zero row stays zero
+    exact = np.divide(exact, norms, out=np.zeros_like(exact), where=norms > 0.0)
+    matrix = exact.astype(np.asarray(matrix).dtype)
+    top = float(np.abs(matrix).max()) if matrix.size else 0.0
+    if mode == 'uint8':
+        scale = top / UINT8_MAX if top > 0 else 1.0
+        codes = np.clip(np.rint(matrix / scale), 0, UINT8_MAX).astype(np.uint8)
+    else:
+        scale = max(1.0, top / FLOAT16_MAX)
+        codes = (matrix / scale).astype(np.float16)
+    rows = QuantizedRows(codes, scale, 0.0)
+    if len(matrix):
+        # measured with the dequantization of the evaluation, (same dtype)
+        residuals = rows.dequantize(dtype=matrix.dtype).astype(np.float64) - exact
+        rows.error = float(np.linalg.norm(residuals, axis=1).max())
+    return rows
+
+if __name__ == "__main__":
+    """
+    analyse the images with the exact and the quantized trained data of the
+    configured storage, (CNN_STORAGE), and compare the results
+    """
+    import cache
+    import filters
+    import main
+    import storage
+    from trained_store import TrainedDataStore
+    min_rows = int(main.pop_option("--min-rows", QUANTIZED_MIN_ROWS))
+    folder = sys.argv[1] if len(sys.argv) > 1 else "test_images"
+    images = sorted(os.path.join(folder, name) for name in os.listdir(folder))
+    cache.FEATURE_CACHE_ENABLED = False
+    with storage.open_storage() as db:
+        exact = TrainedDataStore(db.get_matrices([key for shape in filters.shapes for key in shape['filters']]))
+    stores = {'exact': exact}
+    stores.update((mode, exact.quantized(mode, min_rows)) for mode in QUANTIZATIONS)
+    # the first analysis calibrates the convolution engine, it is not timed
+    main.analyse(images[0], exact)
+    results = {}
+    for name, trained in stores.items():
+        results[name] = {}
+        _start = time.perf_counter()
+        for image in images:
+            try:
+                results[name][image] = main.analyse(image, trained)
+            except Exception as e:
+                print(f"'{image}' skipped: {e}")
+        _elapsed = time.perf_counter() - _start
+        print(f"{name}: {trained.quantized_kernels()} kernels quantized, scanned trained data "
+              f"{trained.scanned_nbytes() / 1024:.1f} KB, analyse time {_elapsed:.3f}s")
+
+    for mode in QUANTIZATIONS:
+        changes = 0
+        cosine_drift = euclidian_drift = 0.0
+        for image, reference in results['exact'].items():
+            result = results[mode].get(image)
+            if result is None:
+                continue
+            cosine_drift = max(cosine_drift, max(abs(result['cosine'][name] - reference['cosine'][name])
+                                                 for name in reference['cosine']))
+            euclidian_drift = max(euclidian_drift, max(abs(result['euclidian'][name] - reference['euclidian'][name])
+                                                       for name in reference['euclidian']))
+            if result['verdict'] != reference['verdict']:
+                changes += 1
+                print(f"{mode}: '{os.path.basename(image)}' {reference['verdict']} -> {result['verdict']}")
+        print(f"{mode}: {changes} verdict change(s) on {len(results['exact'])} images, "
+              f"max cosine drift {cosine_drift:.2e}, max euclidian drift {euclidian_drift:.2e}")
@@ -1,52 +1,138 @@
 import sys
-import asyncio
+import os
+import time
+import queue
+import threading
+import multiprocessing
 import filters
+import main
+from storage import open_storage, BulkWriter, BULK_BATCH_SIZE
 
-async def run_task(folder, shape):
-    """
-    run async training process for a folder and a shape
-    """
-    print("start training data for shape", shape)
-    process = await asyncio.create_subprocess_exec(
-        "python", "main.py", "-t", folder, shape,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
-    )
-    # Read output line by line asynchronously
-    while True:
-        line = await process.stderr.readline()
-        if line:
-            print(line.strip())
-            sys.exit(1)
-        line = await process.stdout.readline()
-        if not line:
-            break
-        print(line.strip())
-    await process.wait()
-
-async def show(stop_event):
-    timeout = 0
-    while not stop_event.is_set():
-        print('elapsed time',timeout,'seconds',end='\r')
-        await asyncio.sleep(1)
-        timeout += 1
-    print(f"elapsed {timeout} seconds")
-
-async def main():
-    stop_event = asyncio.Event()
-    # Create the show task
-    show_elapsed_task = asyncio.create_task(show(stop_event))
+TRAINING_DIR = "training_images"
+# max number of processed images waiting for the database writer
+WRITER_QUEUE_SIZE = 64
+
+def get_training_tasks(db, incremental) -> list:
+    """
+    prepare the kernel tables, returns the (shape index, folder, file name,
+    provenance) tasks for all the shapes, (see main.training_provenance)
+    @param db: database interface
+    @param incremental: only new or changed images are returned
+    """
     tasks = []
-    for shapes in filters.shapes:
-        tasks.append(asyncio.create_task(
-            run_task("training_images/" + shapes['path'], shapes['name']))
-        )
-    # Wait for all training tasks to complete
-    await asyncio.gather(*tasks)
-    # Now stop the timer
-    stop_event.set()
-    await show_elapsed_task
+    for shape_index, shape in enumerate(filters.shapes):
+        folder = TRAINING_DIR + "/" + shape['path']
+        if incremental:
+            images = main.plan_incremental_training(db, shape, folder)
+        else:
+            # cleanup tables
+            for key in shape['filters']:
+                db.create_table(key)
+            images = main.get_training_images(folder)
+        tasks.extend((shape_index, folder, image, digest) for image, digest in images)
+    return tasks
+
+def train_worker(task) -> tuple:
+    """
+    process one training image in a pool worker,
+    returns (task, pooled rows per kernel, error message)
+    @param task: (shape index, folder, file name, provenance)
+    """
+    shape_index, folder, image, _ = task
+    try:
+        return task, main.train_image(folder + "/" + image, filters.shapes[shape_index]), None
+    except Exception as e:
+        return task, None, str(e)
+
+class TrainingWriter(threading.Thread):
+    """
+    single writer owning the database connection,
+    the pooled rows are received through a bounded queue
+    and written in bulk, the whole training is one transaction
+    """
+    def __init__(self, db, batch_size):
+        super().__init__(name="training-writer")
+        self._db = db
+        self._batch_size = batch_size
+        self._queue = queue.Queue(WRITER_QUEUE_SIZE)
+        self.rows = 0
+        self.error = None
+
+    def write(self, pooled_rows, source, content_hash) -> None:
+        self._queue.put((pooled_rows, source, content_hash))
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self.join()
+
+    def run(self) -> None:
+        bulk_writer = BulkWriter(self._db, self._batch_size)
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # keep draining the queue so the producer never blocks
+                continue
+            pooled_rows, source, content_hash = item
+            try:
+                for key, rows in pooled_rows.items():
+                    bulk_writer.add(key, rows, source, content_hash)
+                    self.rows += len(rows)
+            except Exception as e:
+                self.error = e
+        try:
+            if self.error is None:
+                bulk_writer.commit()
+                bulk_writer.report()
+            else:
+                self._db.rollback()
+        except Exception as e:
+            self.error = e
+
+def show(done, total, rows, start) -> None:
+    """
+    display the training progress and throughput
+    """
+    elapsed = max(time.time() - start, 1e-9)
+    print(f"images {done}/{total}, rows {rows}, {done / elapsed:.1f} images/s, "
+          f"{rows / elapsed:.0f} rows/s, elapsed {elapsed:.0f} seconds", end='\r')
+
+def train(jobs, batch_size=BULK_BATCH_SIZE, incremental=False) -> None:
+    """
+    train all the shapes, the images of all the shapes are sharded
+    across a pool of worker processes
+    @param jobs: number of worker processes
+    @param batch_size: number of rows sent to the database in one batch
+    @param incremental: only process new or changed images
+    """
+    with open_storage() as db:
+        tasks = get_training_tasks(db, incremental)
+        chunksize = max(1, len(tasks) // (jobs * 8))
+        writer = TrainingWriter(db, batch_size)
+        writer.start()
+        start = time.time()
+        done = 0
+        try:
+            with multiprocessing.Pool(jobs) as pool:
+                for task, pooled_rows, error in pool.imap_unordered(train_worker, tasks, chunksize):
+                    _, folder, image, digest = task
+                    done += 1
+                    if error is not None:
+                        print(f"\nUnexpected exception during processing image '{folder}/{image}': {error}")
+                    else:
+                        writer.write(pooled_rows, image, digest)
+                    show(done, len(tasks), writer.rows, start)
+        finally:
+            writer.close()
+        show(done, len(tasks), writer.rows, start)
+        print()
+    if writer.error is not None:
+        print(f"❌ Error writing the training data: {writer.error}")
+        sys.exit(1)
     print("training done!")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    jobs = int(main.pop_option("--jobs", 0)) or os.cpu_count()
+    batch_size = int(main.pop_option("--batch-size", BULK_BATCH_SIZE))
+    train(jobs, batch_size, main.pop_flag("--incremental"))
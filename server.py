@@ -0,0 +1,285 @@
+"""
+Module implementing the persistent analysis daemon, (main.py --serve)
+the trained data and the kernels stay resident between requests,
+requests arrive over a local unix socket or http and are grouped
+into micro-batches before being analysed
+"""
+import base64
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import analyzer as ana
+import cnn
+import convolution
+
+# max number of requests analysed in one batch
+BATCH_SIZE = 16
+# time to wait for more requests once the first one arrived, (seconds)
+BATCH_WAIT = 0.01
+HTTP_HOST = '127.0.0.1'
+HTTP_PORT = 8080
+
+class AnalysisService:
+    """
+    class owning the warm model state; a single worker thread drains
+    the request queue in micro-batches, every batch is analysed
+    against one consistent set of trained data
+    """
+    def __init__(self, db, width, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT) -> None:
+        """
+        @param db: trained data source with the data already loaded, (database or snapshot)
+        @param width: image width to resize
+        @param batch_size: max number of requests in a batch
+        @param batch_wait: time to wait for a batch to fill, (seconds)
+        """
+        self._db = db
+        self._width = width
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._queue = queue.Queue()
+        self._reload_lock = threading.Lock()
+        self._trained = None
+        self._worker = None
+        self._stopping = False
+
+    def __enter__(self) -> 'AnalysisService':
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._trained = self._db.trained_data()
+        # calibrate the convolution engine, ('auto' backend), before the first request
+        convolution.default_engine().resolve_backend()
+        self._worker = threading.Thread(target=self.run, name="analysis-worker", daemon=True)
+        self._worker.start()
+
+    def stop(self) -> None:
+        self._queue.put(None)
+        self._worker.join()
+
+    def submit(self, image) -> Future:
+        """
+        queue an image for analysis, returns a future of the result
+        @param image: path to the image file or the image file content
+        """
+        future = Future()
+        self._queue.put((image, future))
+        return future
+
+    def analyse(self, image) -> dict:
+        return self.submit(image).result()
+
+    def reload(self) -> None:
+        """
+        load the trained data again; batches in flight complete with
+        the previous data, the next batch picks up the new one
+        """
+        with self._reload_lock:
+            self._db.load_trained_data()
+            self._trained = self._db.trained_data()
+
+    def next_batch(self) -> list:
+        """
+        block for the first request, then collect more requests until
+        the batch is full or the batch wait time expired
+        """
+        batch = []
+        timeout = None
+        deadline = None
+        while len(batch) < self._batch_size:
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self._stopping = True
+                break
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + self._batch_wait
+            timeout = max(deadline - time.monotonic(), 0)
+        return batch
+
+    def process_batch(self, batch) -> None:
+        """
+        decode the images of a batch one by one, an image which cannot be
+        decoded only fails its own request, then analyse the decoded images
+        together, (analyzer.analyse_images)
+        """
+        trained = self._trained
+        decoded_images = []
+        futures = []
+        for image, future in batch:
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                source = io.BytesIO(image) if isinstance(image, bytes) else image
+                decoded_images.append(cnn.decode_image(source, self._width))
+                futures.append(future)
+            except Exception as e:
+                future.set_exception(e)
+        if not decoded_images:
+            return
+        try:
+            results = ana.analyse_images(decoded_images, trained, self._width)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def run(self) -> None:
+        while not self._stopping:
+            self.process_batch(self.next_batch())
+
+    def handle_request(self, request) -> dict:
+        """
+        execute a decoded request, returns the response
+        @param request: {'path': image path} or {'data': base64 image content}
+                        or {'command': 'reload'}
+        """
+        command = request.get('command', 'analyse')
+        try:
+            if command == 'reload':
+                self.reload()
+                return {'status': 'reloaded'}
+            if command != 'analyse':
+                return {'error': f"unknown command '{command}'"}
+            if 'path' in request:
+                image = request['path']
+            elif 'data' in request:
+                image = base64.b64decode(request['data'])
+            else:
+                return {'error': "request needs an image 'path' or 'data'"}
+            result = self.analyse(image)
+            result['image'] = request.get('path', '<data>')
+            return result
+        except Exception as e:
+            return {'error': str(e)}
+
+def encode(response) -> bytes:
+    return json.dumps(response, default=float).encode()
+
+class UnixRequestHandler(socketserver.StreamRequestHandler):
+    """
+    one json request per line, one json response per line
+    """
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'error': f"invalid request: {e}"}
+            else:
+                response = self.server.service.handle_request(request)
+            self.wfile.write(encode(response) + b"\n")
+
+class HttpRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health
+    GET  /analyse?path=[image file]
+    POST /analyse, json request or the raw image content
+    POST /reload
+    """
+    def send_json(self, response) -> None:
+        body = encode(response)
+        self.send_response(400 if 'error' in response else 200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        if url.path == '/health':
+            self.send_json({'status': 'ok'})
+        elif url.path == '/analyse':
+            query = parse_qs(url.query)
+            request = {'path': query['path'][0]} if 'path' in query else {}
+            self.send_json(self.server.service.handle_request(request))
+        else:
+            self.send_json({'error': f"unknown path '{url.path}'"})
+
+    def do_POST(self) -> None:
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path == '/reload':
+            self.send_json(self.server.service.handle_request({'command': 'reload'}))
+        elif url.path == '/analyse':
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                try:
+                    request = json.loads(body)
+                except ValueError as e:
+                    self.send_json({'error': f"invalid request: {e}"})
+                    return
+            else:
+                request = {'data': base64.b64encode(body).decode()}
+            self.send_json(self.server.service.handle_request(request))
+        else:
+            self.send_json({'error': f"unknown path '{url.path}'"})
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+def serve(db, socket_path, http_port, width) -> None:
+    """
+    run the daemon until interrupted
+    @param db: trained data source with the data already loaded, (database or snapshot)
+    @param socket_path: path of the unix socket to listen on
+    @param http_port: local http port to listen on
+    @param width: image width to resize
+    """
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    with AnalysisService(db, width) as service:
+        unix_server = socketserver.ThreadingUnixStreamServer(socket_path, UnixRequestHandler)
+        http_server = ThreadingHTTPServer((HTTP_HOST, http_port), HttpRequestHandler)
+        servers = [unix_server, http_server]
+        for srv in servers:
+            srv.daemon_threads = True
+            srv.service = service
+            threading.Thread(target=srv.serve_forever, daemon=True).start()
+        print(f"✅ Listening on '{socket_path}' and http://{HTTP_HOST}:{http_port}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            print("stopping...")
+        finally:
+            for srv in servers:
+                srv.shutdown()
+                srv.server_close()
+            os.unlink(socket_path)
+
+def send_request(socket_path, request) -> dict:
+    """
+    client side, send one request to the daemon unix socket
+    @param socket_path: path of the daemon unix socket
+    @param request: request dict, see AnalysisService.handle_request
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(encode(request) + b"\n")
+        with sock.makefile('rb') as response:
+            return json.loads(response.readline())
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage python server.py [unix socket path] [image file | reload]")
+        sys.exit(1)
+    if sys.argv[2] == 'reload':
+        print(send_request(sys.argv[1], {'command': 'reload'}))
+    else:
+        print(send_request(sys.argv[1], {'path': os.path.abspath(sys.argv[2])}))
@@ -0,0 +1,176 @@
+"""
+Module implementing trained data snapshots: all the trained data in one
+versioned binary file which is memory-mapped for analysis, without
+database; concurrent analyzer processes share the same physical pages
+file layout:
+ - fixed header: magic, format version, json index length
+ - json index: filters.py hash and, per kernel, the offset, shape and
+   dtype of the samples matrix, row norms, row means and norm index, and of
+   the codes of a quantized snapshot with their scale and error, (quantization.py)
+ - the arrays, each one aligned on 64 bytes
+"""
+import hashlib
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+import numpy as np
+import filters
+import profiler
+import quantization
+from trained_store import TrainedDataStore
+
+MAGIC = b"CNNSNAP\0"
+SNAPSHOT_VERSION = 1
+HEADER = struct.Struct("<8sII")
+ALIGNMENT = 64
+
+def align(offset) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def filters_hash() -> str:
+    """
+    returns the hash of filters.py, the trained data is only valid for its kernels
+    """
+    with open(filters.__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def kernel_arrays(store, key) -> list:
+    order, sorted_norms = store.get_norm_index(key)
+    arrays = [
+        ("matrix", store.get_trained_matrix(key)),
+        ("norms", store.get_trained_norms(key)),
+        ("means", store.get_trained_means(key)),
+        ("order", order),
+        ("sorted_norms", sorted_norms),
+    ]
+    if store.get_quantized(key) is not None:
+        arrays.append(("codes", store.get_quantized(key).codes))
+    return arrays
+
+def export(store, path) -> None:
+    """
+    write a trained data store to a snapshot file; the file is replaced
+    atomically so running analyzers keep their current mapping
+    @param store: trained data store
+    @param path: snapshot file path
+    """
+    kernels = {}
+    quantized = {}
+    arrays = []
+    offset = 0
+    for key in store.keys():
+        if store.get_quantized(key) is not None:
+            quantized[key] = {'scale': store.get_quantized(key).scale, 'error': store.get_quantized(key).error}
+        kernels[key] = {}
+        for name, array in kernel_arrays(store, key):
+            offset = align(offset)
+            kernels[key][name] = {'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str}
+            arrays.append((offset, np.ascontiguousarray(array)))
+            offset += array.nbytes
+    index = json.dumps({
+        'filters_hash': filters_hash(),
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'kernels': kernels,
+        'quantized': quantized
+    }).encode()
+    data_start = align(HEADER.size + len(index))
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, SNAPSHOT_VERSION, len(index)))
+            f.write(index)
+            for array_offset, array in arrays:
+                f.write(b"\0" * (data_start + array_offset - f.tell()))
+                f.write(array.tobytes())
+        # readable by the analyzers of other users, mkstemp creates 0600 files
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def array_view(buffer, data_start, spec):
+    """
+    returns a read-only view over one array of the mapped file
+    """
+    dtype = np.dtype(spec['dtype'])
+    count = int(np.prod(spec['shape']))
+    array = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + spec['offset'])
+    return array.reshape(spec['shape'])
+
+def read_index(buffer, path) -> tuple:
+    """
+    check the snapshot header, returns the json index and the data offset
+    @param buffer: mapped snapshot file
+    @param path: snapshot file path
+    """
+    if len(buffer) < HEADER.size:
+        raise ValueError(f"'{path}' is not a trained data snapshot")
+    magic, version, index_size = HEADER.unpack(bytes(buffer[:HEADER.size]))
+    if magic != MAGIC:
+        raise ValueError(f"'{path}' is not a trained data snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"snapshot version {version} is not supported, expected {SNAPSHOT_VERSION}")
+    index = json.loads(bytes(buffer[HEADER.size:HEADER.size + index_size]))
+    if index['filters_hash'] != filters_hash():
+        raise ValueError("the snapshot was exported with a different filters.py, export it again")
+    return index, align(HEADER.size + index_size)
+
+def load(path) -> TrainedDataStore:
+    """
+    memory-map a snapshot file, returns a store of views over the file
+    @param path: snapshot file path
+    """
+    buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    index, data_start = read_index(buffer, path)
+    store = TrainedDataStore({})
+    quantized = index.get('quantized', {})
+    for key, specs in index['kernels'].items():
+        arrays = {name: array_view(buffer, data_start, spec) for name, spec in specs.items()}
+        codes = None
+        if key in quantized:
+            codes = quantization.QuantizedRows(arrays['codes'], quantized[key]['scale'], quantized[key]['error'])
+        store.add(key, arrays['matrix'], arrays['norms'], arrays['means'], (arrays['order'], arrays['sorted_norms']),
+                  codes)
+    return store
+
+class Snapshot():
+    """
+    trained data source backed by a snapshot file, used in place
+    of a storage backend for analysis
+    """
+    def __init__(self, path):
+        self._path = path
+        self._trained_data = None
+
+    def __enter__(self):
+        try:
+            read_index(np.memmap(self._path, dtype=np.uint8, mode='r'), self._path)
+        except (OSError, ValueError) as e:
+            print(f"❌ Cannot open snapshot: {e}")
+            sys.exit(1)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        del self._trained_data
+
+    def load_trained_data(self):
+        """
+        map the snapshot file, the previous mapping is replaced
+        once the new one is complete
+        """
+        with profiler.span("load_trained_data", snapshot=self._path):
+            trained_data = load(self._path)
+        self._trained_data = trained_data
+        print(f"✅ Trained data mapped from '{self._path}'.")
+        trained_data.report()
+
+    def trained_data(self):
+        """
+        Returns a consistent view over the currently mapped trained data
+        """
+        return self._trained_data
@@ -0,0 +1,393 @@
+"""
+Module implementing the trained data storage interface and its backends:
+ - postgres, (database.DataBaseInterface), the default
+ - sqlite, embedded in one local file, no database server needed
+the backend is selected with the CNN_STORAGE environment variable
+"""
+import os
+import sqlite3
+import sys
+import time
+import numpy as np
+import filters
+import precision
+import profiler
+from trained_store import TrainedDataStore
+
+# number of buffered rows sent to the storage in one batch
+BULK_BATCH_SIZE = 5000
+STORAGE_BACKENDS = ('postgres', 'sqlite')
+STORAGE_BACKEND = os.environ.get("CNN_STORAGE", "postgres")
+SQLITE_PATH = os.environ.get("CNN_SQLITE_PATH", "trained_data.sqlite")
+# samples table shared by all the kernels, one row per pooled row
+SAMPLES_TABLE = "trained_samples"
+# type of the packed samples
+SAMPLES_DTYPE = np.float64
+# number of trained rows read at once by the streaming evaluation
+STREAM_CHUNK_ROWS = 10000
+
+class StorageInterface():
+    """
+    base of the storage backends; a backend stores the pooled rows of all
+    the kernels in one samples table keyed by (kernel, source image, row
+    index), the loading of the trained data into memory is shared by all
+    the backends
+    """
+    def __init__(self):
+        self._trained_data = TrainedDataStore({})
+
+    def __enter__(self):
+        if self.database_connect() is False:
+            print("❌ Error connecting to database")
+            sys.exit(1)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.database_disconnect()
+        del self._trained_data
+
+    def database_connect(self):
+        raise NotImplementedError
+
+    def database_disconnect(self):
+        raise NotImplementedError
+
+    def get_data(self, key):
+        """
+        returns the rows of a kernel as 1-tuples holding the samples
+        @param key: kernel key
+        """
+        return [(samples.tolist(),) for samples in self.get_matrix(key)]
+
+    def get_matrix(self, key):
+        """
+        returns the samples of a kernel as a (rows, samples) matrix
+        @param key: kernel key
+        """
+        return self.get_matrices([key])[key]
+
+    def get_matrices(self, keys):
+        """
+        returns a map of kernel key to (rows, samples) matrix, in one query
+        @param keys: kernel keys
+        """
+        raise NotImplementedError
+
+    def iter_matrices(self, key, chunk_rows):
+        """
+        yields the samples of a kernel as (rows, samples) matrices of at
+        most chunk_rows rows, the rows are read from the storage lazily
+        @param key: kernel key
+        @param chunk_rows: max number of rows of a matrix
+        """
+        raise NotImplementedError
+
+    def insert_data(self, key, data):
+        raise NotImplementedError
+
+    def copy_rows(self, key, rows):
+        """
+        insert several rows, without commit
+        @param key: kernel key
+        @param rows: list of (samples, source, content hash, row index), samples as lists of floats
+        """
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    def rollback(self):
+        raise NotImplementedError
+
+    def create_table(self, key):
+        """
+        create the samples table if missing and remove the rows of a kernel
+        @param key: kernel key
+        """
+        raise NotImplementedError
+
+    def prepare_table(self, key):
+        """
+        prepare a kernel for incremental training, without commit
+        @param key: kernel key
+        """
+        raise NotImplementedError
+
+    def get_sources(self, key):
+        """
+        returns a map of source file name to content hash for a kernel
+        @param key: kernel key
+        """
+        raise NotImplementedError
+
+    def delete_source(self, key, source):
+        """
+        delete the rows of a source file, without commit
+        @param key: kernel key
+        @param source: source file name
+        """
+        raise NotImplementedError
+
+    def load_trained_data(self):
+        """
+        Loads the all trained data from filters.py into memory with one
+        query, each kernel is decoded to a contiguous matrix; the previous
+        data is replaced once the new one is complete
+        """
+        keys = [key for shape in filters.shapes for key in shape['filters']]
+        with profiler.span("load_trained_data", kernels=len(keys)):
+            trained_data = TrainedDataStore(self.get_matrices(keys))
+        self._trained_data = trained_data
+        print("✅ Trained data loaded successfully.")
+        trained_data.report()
+
+    def trained_data(self):
+        """
+        Returns a consistent view over the currently loaded trained data
+        """
+        return self._trained_data
+
+    def get_trained_data(self, key):
+        """
+        Returns the trained data for a specific kernel key, (rows, samples) matrix
+        @param key: kernel key
+        """
+        return self._trained_data.get_trained_data(key)
+
+    def get_trained_matrix(self, key):
+        return self._trained_data.get_trained_matrix(key)
+
+    def get_trained_norms(self, key):
+        return self._trained_data.get_trained_norms(key)
+
+    def get_trained_means(self, key):
+        return self._trained_data.get_trained_means(key)
+
+    def get_norm_index(self, key):
+        return self._trained_data.get_norm_index(key)
+
+def pack_samples(samples) -> bytes:
+    return np.asarray(samples, dtype=SAMPLES_DTYPE).tobytes()
+
+def unpack_samples(blobs):
+    """
+    decode packed rows to a (rows, samples) matrix
+    @param blobs: list of packed rows, (bytes-like), all of the same length
+    """
+    if len(blobs) == 0:
+        return np.empty((0, 0), dtype=SAMPLES_DTYPE)
+    return np.frombuffer(b"".join(blobs), dtype=SAMPLES_DTYPE).reshape(len(blobs), -1)
+
+def fetch_chunks(cursor, chunk_rows):
+    """
+    yields the packed samples of an executed query as matrices of at most chunk_rows rows
+    @param cursor: cursor of an executed "SELECT samples" query
+    @param chunk_rows: max number of rows of a matrix
+    """
+    while True:
+        with profiler.span("fetch_chunk"):
+            rows = cursor.fetchmany(chunk_rows)
+            matrix = unpack_samples([row[0] for row in rows]) if rows else None
+        if matrix is None:
+            break
+        yield matrix
+
+def group_samples(keys, rows):
+    """
+    decode the fetched (kernel, packed samples) rows, returns a map of
+    kernel key to (rows, samples) matrix
+    @param keys: kernel keys
+    @param rows: iterable of (kernel key, packed samples)
+    """
+    blobs = {key: [] for key in keys}
+    for key, samples in rows:
+        blobs[key].append(samples)
+    return {key: unpack_samples(kernel_blobs) for key, kernel_blobs in blobs.items()}
+
+class SQLiteStorage(StorageInterface):
+    """
+    embedded backend, the samples table lives in one sqlite file,
+    the samples of a row are packed float64 values in a BLOB
+    """
+    def __init__(self, path=SQLITE_PATH):
+        super().__init__()
+        self._path = path
+        self._connection = None
+
+    def database_connect(self):
+        try:
+            # used by the training writer thread and the daemon reload, one thread at a time
+            self._connection = sqlite3.connect(self._path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.Error as e:
+            print(f"❌ Cannot open '{self._path}': {e}")
+            return False
+
+    def database_disconnect(self):
+        if self._connection:
+            self._connection.close()
+
+    def get_matrices(self, keys):
+        keys = list(keys)
+        with profiler.span("fetch_trained_data", backend='sqlite'):
+            cursor = self._connection.execute(
+                f"SELECT kernel, samples FROM {SAMPLES_TABLE} WHERE kernel IN ({','.join('?' * len(keys))}) "
+                "ORDER BY kernel, source, row_index", keys)
+            return group_samples(keys, cursor)
+
+    def iter_matrices(self, key, chunk_rows):
+        cursor = self._connection.execute(
+            f"SELECT samples FROM {SAMPLES_TABLE} WHERE kernel = ? ORDER BY source, row_index", (key,))
+        yield from fetch_chunks(cursor, chunk_rows)
+
+    def insert_data(self, key, data):
+        self._connection.execute(
+            f"INSERT INTO {SAMPLES_TABLE} (kernel, row_index, samples) "
+            f"SELECT ?, COALESCE(MAX(row_index) + 1, 0), ? FROM {SAMPLES_TABLE} WHERE kernel = ? AND source IS NULL",
+            (key, pack_samples(data), key))
+        self._connection.commit()
+
+    def copy_rows(self, key, rows):
+        self._connection.executemany(
+            f"INSERT INTO {SAMPLES_TABLE} (kernel, source, content_hash, row_index, samples) VALUES (?, ?, ?, ?, ?)",
+            ((key, source, content_hash, row_index, pack_samples(samples))
+             for samples, source, content_hash, row_index in rows))
+
+    def commit(self):
+        self._connection.commit()
+
+    def rollback(self):
+        self._connection.rollback()
+
+    def create_samples_table(self):
+        self._connection.execute(f"CREATE TABLE IF NOT EXISTS {SAMPLES_TABLE} ("
+                                 "kernel TEXT NOT NULL, source TEXT, content_hash TEXT, "
+                                 "row_index INTEGER NOT NULL, samples BLOB NOT NULL, "
+                                 "UNIQUE (kernel, source, row_index));")
+
+    def create_table(self, key):
+        self.create_samples_table()
+        self._connection.execute(f"DELETE FROM {SAMPLES_TABLE} WHERE kernel = ?", (key,))
+        print(f"✅ Samples of '{key}' removed successfully.")
+        self._connection.commit()
+
+    def prepare_table(self, key):
+        self.create_samples_table()
+        self._connection.execute(f"DELETE FROM {SAMPLES_TABLE} WHERE kernel = ? AND source IS NULL", (key,))
+
+    def get_sources(self, key):
+        cursor = self._connection.execute(
+            f"SELECT DISTINCT source, content_hash FROM {SAMPLES_TABLE} WHERE kernel = ?", (key,))
+        return dict(cursor.fetchall())
+
+    def delete_source(self, key, source):
+        self._connection.execute(f"DELETE FROM {SAMPLES_TABLE} WHERE kernel = ? AND source = ?", (key, source))
+
+class StreamingTrainedData():
+    """
+    trained data read from the storage in chunks of rows at every evaluation
+    instead of being loaded, the memory use does not depend on the size of
+    the training set; same chunks() interface as trained_store.TrainedDataStore
+    """
+    def __init__(self, storage, chunk_rows=STREAM_CHUNK_ROWS):
+        """
+        @param storage: connected storage interface
+        @param chunk_rows: max number of trained rows held at once
+        """
+        self._storage = storage
+        self._chunk_rows = chunk_rows
+
+    def chunks(self, key):
+        """
+        yields the trained data of a kernel as (matrix, norms, norm index,
+        quantized samples) chunks in the selected precision, the norm index is
+        left to the evaluation and the samples are not quantized
+        @param key: kernel key
+        """
+        for matrix in self._storage.iter_matrices(key, self._chunk_rows):
+            matrix = matrix.astype(precision.compute_dtype(), copy=False)
+            yield matrix, np.linalg.norm(matrix, axis=1), None, None
+
+def open_storage(backend=None):
+    """
+    returns the storage interface of the configured backend, not connected
+    @param backend: backend name, CNN_STORAGE if not specified
+    """
+    backend = backend or STORAGE_BACKEND
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    if backend == 'postgres':
+        # psycopg2 is only needed by the postgres backend
+        import database
+        return database.DataBaseInterface(
+            os.environ.get("CNN_PG_HOST", "localhost"),
+            os.environ.get("CNN_PG_DATABASE", "myapp"),
+            os.environ.get("CNN_PG_USER", "postgres"),
+            os.environ.get("CNN_PG_PASSWORD", "password"),
+            int(os.environ.get("CNN_PG_PORT", 5432)))
+    raise ValueError(f"unknown storage backend '{backend}', expected one of {STORAGE_BACKENDS}")
+
+class BulkWriter():
+    """
+    buffered writer for the training output, the rows are sent with
+    copy_rows once batch_size rows are buffered and committed by commit()
+    or when the writer is closed, in one transaction
+    """
+    def __init__(self, db, batch_size=BULK_BATCH_SIZE):
+        """
+        @param db: connected storage interface
+        @param batch_size: number of buffered rows sent in one batch
+        """
+        self._db = db
+        self._batch_size = batch_size
+        self._buffer = {}
+        self._buffered = 0
+        self._start = time.time()
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+            self.report()
+        else:
+            self._db.rollback()
+
+    def add(self, table_name, rows, source=None, content_hash=None):
+        """
+        buffer the pooled rows of a kernel
+        @param table_name: kernel key
+        @param rows: list of samples of one image, (lists of floats)
+        @param source: training image file name
+        @param content_hash: content hash of the training image
+        """
+        self._buffer.setdefault(table_name, []).extend(
+            (row, source, content_hash, row_index) for row_index, row in enumerate(rows))
+        self._buffered += len(rows)
+        if self._buffered >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        for table_name, rows in self._buffer.items():
+            self._db.copy_rows(table_name, rows)
+            self.rows += len(rows)
+        self._buffer = {}
+        self._buffered = 0
+
+    def commit(self):
+        self.flush()
+        self._db.commit()
+
+    def rows_per_second(self):
+        return self.rows / max(time.time() - self._start, 1e-9)
+
+    def report(self):
+        print(f"✅ {self.rows} rows written, {self.rows_per_second():.0f} rows/s")
+
+if __name__ == "__main__":
+    with open_storage() as db:
+        for row in db.get_data('digit_3_filter_1'):
+            print("res=", row)
@@ -0,0 +1,191 @@
+"""
+Module implementing the in-memory trained data store: the samples of
+each kernel are held in one contiguous, read-only (rows, samples)
+matrix, in the selected precision, (precision.py), with the row norms,
+the row means and the norm index computed once at load time; the
+analyzer gets zero-copy views; the samples may also be held quantized,
+(quantization.py), next to the exact rows
+"""
+import numpy as np
+import precision
+import quantization
+
+def rows_to_matrix(rows):
+    """
+    convert fetched rows, (1-tuples holding lists of floats), to a matrix
+    @param rows: rows as returned by the database
+    """
+    if len(rows) == 0:
+        return np.empty((0, 0), dtype=np.float64)
+    return np.array([row[0] for row in rows], dtype=np.float64)
+
+class TrainedDataStore:
+    """
+    read-only store over one loaded set of trained data; a reload
+    creates a new store so readers keep a consistent set
+    """
+    def __init__(self, matrices) -> None:
+        """
+        @param matrices: map of kernel key to (rows, samples) matrix
+        """
+        self._matrices = {}
+        self._norms = {}
+        self._means = {}
+        self._norm_index = {}
+        self._quantized = {}
+        for key, matrix in matrices.items():
+            self.add(key, matrix)
+
+    @classmethod
+    def from_rows(cls, trained_rows) -> 'TrainedDataStore':
+        """
+        build a store from the rows fetched per kernel
+        @param trained_rows: map of kernel key to the fetched rows
+        """
+        return cls({key: rows_to_matrix(rows) for key, rows in trained_rows.items()})
+
+    def add(self, key, matrix, norms=None, means=None, norm_index=None, quantized=None) -> None:
+        """
+        store the samples of a kernel and compute its norms, means and norm
+        index, unless they are provided, (e.g. loaded from a snapshot)
+        @param key: kernel key
+        @param matrix: (rows, samples) matrix
+        @param norms: norm of each row
+        @param means: mean of each row
+        @param norm_index: (row order, sorted norms)
+        @param quantized: quantized samples of the rows, (quantization.QuantizedRows)
+        """
+        dtype = precision.compute_dtype()
+        if np.asarray(matrix).dtype != dtype:
+            # e.g. a snapshot exported in the other precision, the derived arrays are computed again
+            norms = means = norm_index = None
+            if quantized is not None:
+                # the quantization error was measured in the other precision
+                quantized = quantization.quantize(np.asarray(matrix, dtype=dtype), quantized.mode)
+        matrix = np.ascontiguousarray(matrix, dtype=dtype)
+        matrix.flags.writeable = False
+        if norms is None:
+            norms = np.linalg.norm(matrix, axis=1)
+        if means is None:
+            means = matrix.mean(axis=1) if matrix.shape[1] else np.zeros(len(matrix), dtype=dtype)
+        if norm_index is None:
+            order = np.argsort(norms, kind='stable')
+            norm_index = (order, norms[order])
+        order, sorted_norms = norm_index
+        for array in (norms, means, order, sorted_norms):
+            array.flags.writeable = False
+        self._matrices[key] = matrix
+        self._norms[key] = norms
+        self._means[key] = means
+        self._norm_index[key] = (order, sorted_norms)
+        if quantized is not None:
+            quantized.codes.flags.writeable = False
+            self._quantized[key] = quantized
+        else:
+            self._quantized.pop(key, None)
+
+    def quantized(self, mode, min_rows=quantization.QUANTIZED_MIN_ROWS) -> 'TrainedDataStore':
+        """
+        returns a store over the same rows with the samples of the kernels of
+        at least min_rows rows quantized, (quantization.quantize)
+        @param mode: one of quantization.QUANTIZATIONS
+        @param min_rows: smaller kernels keep only their exact samples
+        """
+        if mode not in quantization.QUANTIZATIONS:
+            raise ValueError(f"unknown quantization '{mode}', expected one of {quantization.QUANTIZATIONS}")
+        store = TrainedDataStore({})
+        for key, matrix in self._matrices.items():
+            quantized = quantization.quantize(matrix, mode) if len(matrix) >= min_rows else None
+            store.add(key, matrix, self._norms[key], self._means[key], self._norm_index[key], quantized)
+        return store
+
+    def quantized_kernels(self) -> int:
+        return len(self._quantized)
+
+    def keys(self) -> list:
+        return list(self._matrices)
+
+    def get_trained_matrix(self, key):
+        """
+        Returns the trained samples of a kernel as a (rows, samples) matrix
+        @param key: kernel key
+        """
+        return self._matrices[key]
+
+    def get_trained_data(self, key):
+        return self._matrices[key]
+
+    def get_trained_norms(self, key):
+        """
+        Returns the euclidian norm of each trained row of a kernel
+        @param key: kernel key
+        """
+        return self._norms[key]
+
+    def get_trained_means(self, key):
+        """
+        Returns the mean of each trained row of a kernel
+        @param key: kernel key
+        """
+        return self._means[key]
+
+    def get_norm_index(self, key):
+        """
+        Returns (row order, sorted norms), the trained rows of a kernel sorted by norm
+        @param key: kernel key
+        """
+        return self._norm_index[key]
+
+    def get_quantized(self, key):
+        """
+        Returns the quantized samples of a kernel, (quantization.QuantizedRows),
+        None when the kernel is not quantized
+        @param key: kernel key
+        """
+        return self._quantized.get(key)
+
+    def chunks(self, key):
+        """
+        yields the trained data of a kernel as (matrix, norms, norm index,
+        quantized samples or None) chunks, a single chunk since all the data
+        is in memory; see storage.StreamingTrainedData for the chunked reading
+        @param key: kernel key
+        """
+        yield self._matrices[key], self._norms[key], self._norm_index[key], self._quantized.get(key)
+
+    def rows(self) -> int:
+        return sum(len(matrix) for matrix in self._matrices.values())
+
+    def nbytes(self) -> int:
+        """
+        returns the memory footprint of the store in bytes
+        """
+        total = 0
+        for key in self._matrices:
+            order, sorted_norms = self._norm_index[key]
+            total += self._matrices[key].nbytes + self._norms[key].nbytes + self._means[key].nbytes
+            total += order.nbytes + sorted_norms.nbytes
+            if key in self._quantized:
+                total += self._quantized[key].codes.nbytes
+        return total
+
+    def scanned_nbytes(self) -> int:
+        """
+        returns the size of the arrays read in full by the evaluation of all
+        the kernels: the samples, or their codes when quantized, and the norms;
+        the exact samples of a quantized kernel are only read for the rows
+        re-ranked by the evaluation
+        """
+        total = 0
+        for key, matrix in self._matrices.items():
+            samples = self._quantized[key].codes if key in self._quantized else matrix
+            total += samples.nbytes + self._norms[key].nbytes
+        return total
+
+    def report(self) -> None:
+        print(f"✅ Trained data: {len(self._matrices)} kernels, {self.rows()} rows, "
+              f"{self.nbytes() / (1024 * 1024):.2f} MB")
+        if self._quantized:
+            modes = sorted({quantized.mode for quantized in self._quantized.values()})
+            print(f"✅ {len(self._quantized)} kernels quantized, ({', '.join(modes)}), "
+                  f"{self.scanned_nbytes() / (1024 * 1024):.2f} MB scanned by the evaluation")
@@ -1,6 +1,32 @@
 """
 verdict module, issue the final verdict based on analyzer results
 """
+import numpy as np
+import precision
+
+# min cosine evaluation of a shape, (sum of the kernel max similarities), to consider any result
+COSINE_THRESHOLD = 5.999
+# max similarity of one kernel, 1 with a margin for the rounding of the cosine
+# in the selected precision, (a float32 similarity reaches 1 + 1.2e-7)
+KERNEL_COSINE_BOUND = 1.0 + 1e-9
+KERNEL_COSINE_BOUND_FLOAT32 = 1.0 + 1e-5
+
+def kernel_cosine_bound() -> float:
+    """
+    returns the max similarity of one kernel in the selected precision, (precision.py)
+    """
+    if precision.compute_dtype() == np.float64:
+        return KERNEL_COSINE_BOUND
+    return KERNEL_COSINE_BOUND_FLOAT32
+
+def cosine_reachable(cosine_sum, remaining_kernels):
+    """
+    returns False when the cosine evaluation of a shape can not reach the
+    threshold anymore, whatever the similarities of its remaining kernels
+    @param cosine_sum: sum of the max similarities of the evaluated kernels
+    @param remaining_kernels: number of kernels of the shape not evaluated yet
+    """
+    return cosine_sum + remaining_kernels * kernel_cosine_bound() >= COSINE_THRESHOLD
 
 def check_for_100_shape(eucl_results, shape_with_max_eucl):
     """
@@ -41,7 +67,7 @@ def verdict(cosine_result, eucl_result):
     result = "Unknown pattern"
 
     # do not consider any results if cosine evaluation is low
-    if max(cosine_result.values()) < 5.999:
+    if max(cosine_result.values()) < COSINE_THRESHOLD:
         return result
 
     __shape = check_for_100_shape(eucl_result, eucl_shape_match)